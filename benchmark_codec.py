@@ -0,0 +1,54 @@
+import argparse
+from datetime import datetime
+from io import BytesIO
+import sys
+import timeit
+import numpy as np
+from shapeworld import dataset, util
+from shapeworld.dataset import decode_image, encode_image
+
+
+def encode_npy(world_array):
+    array_bytes = BytesIO()
+    np.save(array_bytes, (world_array * 255.0).astype(dtype=np.uint8), allow_pickle=False)
+    return array_bytes.getvalue()
+
+
+def decode_npy(array_bytes):
+    return np.load(BytesIO(array_bytes), allow_pickle=False).astype(dtype=np.float32) / 255.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare size and decoding time of world image formats')
+
+    parser.add_argument('-t', '--type', default='agreement', help='Dataset type')
+    parser.add_argument('-n', '--name', default='multishape', help='Dataset name')
+    parser.add_argument('-l', '--language', default=None, help='Dataset language')
+    parser.add_argument('-c', '--config', type=util.parse_config, default=None, help='Dataset configuration file')
+    parser.add_argument('-i', '--instances', type=util.parse_int_with_factor, default=100, help='Number of worlds')
+    parser.add_argument('-p', '--pixel-noise', type=float, default=0.0, help='Pixel noise range')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed decoding repeats')
+    args = parser.parse_args()
+
+    dataset = dataset(dtype=args.type, name=args.name, language=args.language, config=args.config)
+    sys.stdout.write('{time} {dataset}\n'.format(time=datetime.now().strftime('%H:%M:%S'), dataset=dataset))
+    generated = dataset.generate(n=args.instances, mode='train', noise_range=args.pixel_noise)
+    worlds = [world for value_name, value_type in dataset.values.items() if value_type == 'world' for world in generated[value_name]]
+    reference = [(world * 255.0).astype(dtype=np.uint8) for world in worlds]
+
+    codecs = (
+        ('bmp', (lambda world: encode_image(world_array=world, image_format='bmp')), (lambda world_bytes: decode_image(image_bytes=world_bytes, image_format='bmp'))),
+        ('png', (lambda world: encode_image(world_array=world, image_format='png')), (lambda world_bytes: decode_image(image_bytes=world_bytes, image_format='png'))),
+        ('rle', (lambda world: encode_image(world_array=world, image_format='rle')), (lambda world_bytes: decode_image(image_bytes=world_bytes, image_format='rle'))),
+        ('npy', encode_npy, decode_npy)
+    )
+    sys.stdout.write('         {} worlds of shape {}\n'.format(len(worlds), dataset.world_shape))
+    sys.stdout.write('         format   bytes/world   decode ms/world   lossless\n')
+    for name, encode, decode in codecs:
+        encoded = [encode(world) for world in worlds]
+        size = sum(len(world_bytes) for world_bytes in encoded) / len(encoded)
+        decoded = [decode(world_bytes) for world_bytes in encoded]
+        lossless = all(np.array_equal((world * 255.0).round().astype(dtype=np.uint8), pixels) for world, pixels in zip(decoded, reference))
+        seconds = min(timeit.repeat(stmt=(lambda: [decode(world_bytes) for world_bytes in encoded]), number=1, repeat=args.repeats))
+        sys.stdout.write('         {:<6} {:>13.0f} {:>17.3f}   {}\n'.format(name, size, seconds * 1000.0 / len(encoded), lossless))
+    sys.stdout.flush()
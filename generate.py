@@ -1,12 +1,62 @@
 import argparse
 from datetime import datetime
 import json
+from multiprocessing import Pool
 import os
 import shutil
 import sys
 from shapeworld import dataset, util
 
 
+def initialize_worker(dtype, name, language, config, metrics_interval, stats):
+    from shapeworld import dataset
+    global worker_dataset
+    worker_dataset = dataset(dtype=dtype, name=name, language=language, config=config)
+    if metrics_interval is not None or stats:
+        worker_dataset.metrics = util.Metrics(interval=metrics_interval)
+
+
+def part_number(path):
+    filename = os.path.basename(path)
+    return int(filename[4:].split('.')[0])
+
+
+def generate_chunks(mode, metadata, args):
+    # generated and written in chunks, so memory does not depend on the number of instances, output is the same for any
+    # chunk size except for text selection datasets without caption bank, which select distractors within each chunk
+    for start in range(0, args.instances, args.chunk_size):
+        # metadata index values from the instance metadata of the dataset, so models are not required
+        generated = worker_dataset.generate(n=min(args.chunk_size, args.instances - start), mode=mode, noise_range=args.pixel_noise, include_model=args.include_model, alternatives=True)
+        if args.metadata_index:
+            metadata.extend(worker_dataset.metadata(generated=generated))
+        yield generated
+
+
+def generate_part(task):
+    mode, path, tf_records_flag, seed, part_key, args = task
+    before = datetime.now()
+    stats = worker_dataset.stats
+    util.set_random_seed(seed, part_key)
+    worker_dataset.set_random_seed(seed=seed, part=part_key)
+    metadata = list()
+    chunks = generate_chunks(mode=mode, metadata=metadata, args=args)
+    if tf_records_flag:
+        from shapeworld import tf_util
+        tf_util.write_records(dataset=worker_dataset, records=chunks, path=path)
+        path += '.tfrecords.gz'
+    else:
+        with worker_dataset.writer(path=path, num_instances=args.instances, archive=args.archive, concat_worlds=args.concatenate_images, html=args.html, storage=args.storage, image_format=args.image_format, image_threads=args.image_threads, include_worlds=(not args.render_on_load), model_format=args.model_format) as write:
+            for generated in chunks:
+                write(generated=generated)
+        path = util.Archive.get_path(path=path, archive=args.archive)
+    checksum, size = util.checksum(path=path)
+    if stats is not None:
+        # recorded for this part, since worker datasets generate several parts
+        stats = util.Metrics.difference(values=worker_dataset.stats, previous=stats)
+    after = datetime.now()
+    return after - before, dict(path=path, num_instances=args.instances, size=size, checksum=checksum, seed=seed), metadata, stats
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate example data')
 
@@ -23,31 +73,52 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--mode', default=None, choices=('train', 'validation', 'test', 'tf-records'), help='Mode')
     parser.add_argument('-f', '--files', type=util.parse_tuple, default=None, help='Number of files to split data into (not specified implies --unmanaged)')
     parser.add_argument('-i', '--instances', type=util.parse_int_with_factor, default=100, help='Number of instances per file')
+    parser.add_argument('-k', '--chunk-size', type=util.parse_int_with_factor, default=1000, help='Number of instances generated and written at a time (also the distractor pool of text selection datasets without caption bank)')
 
     parser.add_argument('-p', '--pixel-noise', type=float, default=0.0, help='Pixel noise range')
     parser.add_argument('-M', '--include-model', action='store_true', help='Include world/caption model (as json file)')
+    parser.add_argument('-F', '--model-format', default='compact', choices=('compact', 'json'), help='File format of models in text and npy storage (records: json; compact: structured arrays of world entities and prefix-encoded trees of caption models, decoded lazily)')
+    parser.add_argument('-R', '--render-on-load', action='store_true', help='Store world models instead of worlds, which are rendered on loading (implies --include-model)')
+    parser.add_argument('-S', '--storage', default='text', choices=('text', 'npy', 'records'), help='Storage format of values (npy: one binary column per value, memory-mapped on loading; records: one binary record per instance with offset index, for random access)')
+    parser.add_argument('-I', '--image-format', default='bmp', choices=('bmp', 'png', 'rle'), help='Image file format of worlds in text storage (png: smaller, lossless; rle: palette and run-length encoding, lossless)')
+    parser.add_argument('-T', '--image-threads', type=int, default=1, help='Number of threads encoding images per process')
     parser.add_argument('-C', '--concatenate-images', action='store_true', help='Concatenate images per part into one image file')
-    parser.add_argument('-H', '--html', action='store_true', help='Create HTML file showing the generated data')
+    parser.add_argument('-H', '--html', action='store_true', help='Create HTML file showing the generated data (of the first chunk)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes generating parts in parallel')
+    parser.add_argument('-X', '--stats', action='store_true', help='Print wall time per generation stage and generation counters after completion')
+    parser.add_argument('-L', '--metrics-interval', type=float, default=None, help='Write generation counters and timings as json lines to stderr every given number of seconds (per process)')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='Random seed (each part uses an independent stream derived from it)')
     # parser.add_argument('-v', '--values', default=None, help='Comma-separated list of values to include')
     args = parser.parse_args()
     print(args.name)
     dataset = dataset(dtype=args.type, name=args.name, language=args.language, config=args.config)
     print(dataset.name)
+    if args.metrics_interval is not None or args.stats:
+        dataset.metrics = util.Metrics(interval=args.metrics_interval)
     sys.stdout.write('{time} {dataset}\n'.format(time=datetime.now().strftime('%H:%M:%S'), dataset=dataset))
     sys.stdout.write('         config: {config}\n'.format(config=args.config))
     sys.stdout.flush()
 
-    if args.instances * util.product(dataset.world_shape) > 5e8:  # > 500MB
-        sys.stdout.write('{time} warning: part size is {size}MB '.format(time=datetime.now().strftime('%H:%M:%S'), size=int(args.instances * util.product(dataset.world_shape) / 1e6)))
-        sys.stdout.flush()
-        if sys.stdin.readline()[:-1].lower() in ('n', 'no', 'c', 'cancel', 'a', 'abort'):
-            exit(0)
+    if args.storage == 'records':
+        # records contain models as json
+        args.model_format = 'json'
+    if args.render_on_load:
+        args.include_model = True
+        assert all(value_name + '_model' in dataset.values for value_name, value_type in dataset.values.items() if value_type == 'world')
 
     specification = dataset.specification()
     if args.archive:
         specification['archive'] = args.archive
     if args.include_model:
         specification['include_model'] = args.include_model
+    if args.storage != 'text':
+        specification['storage'] = args.storage
+    if args.include_model and args.model_format != 'json':
+        specification['model_format'] = args.model_format
+    if args.render_on_load:
+        specification['render_worlds'] = True
+    if args.image_format != 'bmp':
+        specification['image_format'] = args.image_format
     if args.concatenate_images:
         specification['num_concat_worlds'] = args.instances
 
@@ -61,7 +132,6 @@ if __name__ == '__main__':
             assert len(args.files) == 1
             parts = args.files
         if args.mode == 'tf-records':
-            from shapeworld import tf_util
             modes = ('train',)
             tf_records_flags = (True,)
         else:
@@ -81,7 +151,6 @@ if __name__ == '__main__':
         parts = args.files
         if len(parts) == 1:
             if args.mode == 'tf-records':
-                from shapeworld import tf_util
                 modes = ('train',)
                 tf_records_flags = (True,)
             else:
@@ -95,12 +164,24 @@ if __name__ == '__main__':
             tf_records_flags = (False, False, False)
         else:
             assert args.mode is None
-            from shapeworld import tf_util
             modes = ('train', 'train', 'validation', 'test')
             directories = tuple(os.path.join(directory, mode) for mode in ('tf-records', 'train', 'validation', 'test'))
             tf_records_flags = (True, False, False, False)
 
-    if args.append:
+    manifest_path = None if args.unmanaged else os.path.join(directory, 'manifest.json')
+    if args.append and manifest_path is not None and os.path.isfile(manifest_path):
+        # highest part numbers from the manifest
+        with open(manifest_path, 'r') as filehandle:
+            manifest = json.load(fp=filehandle)
+        start_part = ()
+        for subdir in directories:
+            mode_parts = manifest['parts'].get(os.path.basename(subdir), ())
+            start_part += (max((part_number(path=part['path']) for part in mode_parts), default=0),)
+        with open(specification_path, 'r') as filehandle:
+            assert json.load(filehandle) == specification, str(specification)
+    elif args.append:
+        # parts of data without manifest are not listed
+        manifest = None
         start_part = ()
         for subdir in directories:
             for root, dirs, files in os.walk(subdir):
@@ -117,6 +198,7 @@ if __name__ == '__main__':
             with open(specification_path, 'r') as filehandle:
                 assert json.load(filehandle) == specification, str(specification)
     else:
+        manifest = dict(storage=args.storage, parts=dict())
         start_part = (0,) * len(directories)
         if not args.unmanaged and os.path.isdir(directory):
             shutil.rmtree(directory)
@@ -130,27 +212,65 @@ if __name__ == '__main__':
             for subdir in directories:
                 os.makedirs(subdir)
 
-    for mode, directory, num_parts, start, tf_records_flag in zip(modes, directories, parts, start_part, tf_records_flags):
-        sys.stdout.write('{time} generate {dtype} {name}{mode} data...\n'.format(time=datetime.now().strftime('%H:%M:%S'), dtype=dataset.type, name=dataset.name, mode=(' ' + mode if mode else '')))
-        sys.stdout.write('         0%  0/{files}  (time per part: n/a)'.format(files=num_parts))
-        sys.stdout.flush()
+    # metadata index of instances kept alongside the manifest
+    args.metadata_index = manifest_path is not None and manifest is not None
+    if args.metadata_index:
+        index = util.MetadataIndex(path=os.path.join(directory, 'metadata.sqlite'))
+
+    if args.seed is None:
+        args.seed = int.from_bytes(os.urandom(4), byteorder='little')
+    sys.stdout.write('         seed: {seed}\n'.format(seed=args.seed))
+
+    tasks = list()
+    for mode, subdirectory, num_parts, start, tf_records_flag in zip(modes, directories, parts, start_part, tf_records_flags):
         for part in range(1, num_parts + 1):
-            before = datetime.now()
             if args.unmanaged and len(parts) == 1 and parts[0] == 1:
-                path = directory
+                path = subdirectory
             else:
-                path = os.path.join(directory, 'part{}'.format(start + part))
-            generated = dataset.generate(n=args.instances, mode=mode, noise_range=args.pixel_noise, include_model=args.include_model, alternatives=True)
-            if generated is None:
-                assert False
-            elif tf_records_flag:
-                tf_util.write_records(dataset=dataset, records=generated, path=path)
-            else:
-                dataset.serialize(path=path, generated=generated, archive=args.archive, concat_worlds=args.concatenate_images, html=args.html)
-            after = datetime.now()
-            sys.stdout.write('\r         {completed:.0f}%  {part}/{parts}  (time per part: {duration})'.format(completed=((part) * 100 / num_parts), part=part, parts=num_parts, duration=str(after - before).split('.')[0]))
-            sys.stdout.flush()
-        sys.stdout.write('\n')
+                path = os.path.join(subdirectory, 'part{}'.format(start + part))
+            part_key = '{}/part{}'.format(os.path.basename(os.path.normpath(subdirectory)), start + part)
+            tasks.append((mode, path, tf_records_flag, args.seed, part_key, args))
+
+    sys.stdout.write('{time} generate {dtype} {name}{modes} data...\n'.format(time=datetime.now().strftime('%H:%M:%S'), dtype=dataset.type, name=dataset.name, modes=''.join(' ' + mode for mode in modes if mode)))
+    sys.stdout.write('         0%  0/{parts}  (time per part: n/a, remaining: n/a)'.format(parts=len(tasks)))
+    sys.stdout.flush()
+    start_time = datetime.now()
+    if args.jobs > 1:
+        pool = Pool(processes=args.jobs, initializer=initialize_worker, initargs=(args.type, args.name, args.language, args.config, args.metrics_interval, args.stats))
+        durations = pool.imap_unordered(generate_part, tasks)
+    else:
+        worker_dataset = dataset
+        durations = map(generate_part, tasks)
+    stats = util.Metrics()
+    for completed, (duration, part, metadata, part_stats) in enumerate(durations, 1):
+        if args.stats:
+            stats.record(**part_stats)
+        if args.metadata_index:
+            # updated per part, so interrupted generation leaves a consistent manifest and index
+            part['path'] = os.path.relpath(part['path'], directory)
+            index.add_part(mode=os.path.dirname(part['path']), part=part['path'], metadata=metadata)
+            mode_parts = manifest['parts'].setdefault(os.path.dirname(part['path']), list())
+            mode_parts.append(part)
+            mode_parts.sort(key=(lambda part: part_number(path=part['path'])))
+            util.write_atomic(path=manifest_path, value=json.dumps(manifest))
+        elapsed = datetime.now() - start_time
+        remaining = elapsed * (len(tasks) - completed) / completed
+        sys.stdout.write('\r         {percent:.0f}%  {completed}/{parts}  (time per part: {duration}, remaining: {remaining})'.format(percent=(completed * 100 / len(tasks)), completed=completed, parts=len(tasks), duration=str(duration).split('.')[0], remaining=str(remaining).split('.')[0]))
         sys.stdout.flush()
+    if args.jobs > 1:
+        pool.close()
+        pool.join()
+    if args.metadata_index:
+        index.close()
+    sys.stdout.write('\n')
     sys.stdout.write('{time} data generation completed\n'.format(time=datetime.now().strftime('%H:%M:%S')))
+    if args.stats:
+        # stages nested by prefix, e.g. generate/rendering as part of generate
+        num_instances = max(stats.counters['instances'], 1)
+        sys.stdout.write('         stage                                 seconds   ms/instance\n')
+        for stage, seconds in sorted(stats.timings.items()):
+            sys.stdout.write('         {:<36} {:>8.2f} {:>13.3f}\n'.format(stage, seconds, seconds * 1000.0 / num_instances))
+        sys.stdout.write('         counter                                 count\n')
+        for counter, count in sorted(stats.counters.items()):
+            sys.stdout.write('         {:<36} {:>10}\n'.format(counter, count))
     sys.stdout.flush()
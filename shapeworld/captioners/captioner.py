@@ -154,23 +154,23 @@ class CaptionerMixer(WorldCaptioner):
             logical_contradiction_rate=logical_contradiction_rate
         )
         distribution = util.value_or_default(distribution, [1] * len(captioners))
-        self.distribution = util.cumulative_distribution(distribution)
-        self.train_distribution = util.cumulative_distribution(util.value_or_default(train_distribution, distribution))
-        self.validation_distribution = util.cumulative_distribution(util.value_or_default(validation_distribution, distribution))
-        self.test_distribution = util.cumulative_distribution(util.value_or_default(test_distribution, distribution))
+        self.distribution = util.AliasSampler(distribution)
+        self.train_distribution = util.AliasSampler(util.value_or_default(train_distribution, distribution))
+        self.validation_distribution = util.AliasSampler(util.value_or_default(validation_distribution, distribution))
+        self.test_distribution = util.AliasSampler(util.value_or_default(test_distribution, distribution))
 
     def sample_values(self, mode, correct, predication):
         if not super(CaptionerMixer, self).sample_values(mode=mode, correct=correct, predication=predication):
             return False
 
         if mode is None:
-            self.captioner = util.sample(self.distribution, self.internal_captioners)
+            self.captioner = self.distribution.sample(self.internal_captioners)
         elif mode == 'train':
-            self.captioner = util.sample(self.train_distribution, self.internal_captioners)
+            self.captioner = self.train_distribution.sample(self.internal_captioners)
         elif mode == 'validation':
-            self.captioner = util.sample(self.validation_distribution, self.internal_captioners)
+            self.captioner = self.validation_distribution.sample(self.internal_captioners)
         elif mode == 'test':
-            self.captioner = util.sample(self.test_distribution, self.internal_captioners)
+            self.captioner = self.test_distribution.sample(self.internal_captioners)
 
         return self.captioner.sample_values(mode=mode, correct=correct, predication=predication)
 
@@ -22,7 +22,7 @@ class ConjunctionCaptioner(WorldCaptioner):
             logical_contradiction_rate=logical_contradiction_rate
         )
 
-        self.incorrect_distribution = util.cumulative_distribution(util.value_or_default(incorrect_distribution, [1, 1, 1]))
+        self.incorrect_distribution = util.AliasSampler(util.value_or_default(incorrect_distribution, [1, 1, 1]))
 
     def set_realizer(self, realizer):
         if not super(ConjunctionCaptioner, self).set_realizer(realizer=realizer):
@@ -48,7 +48,7 @@ class ConjunctionCaptioner(WorldCaptioner):
         self.captioner1 = choice(self.internal_captioners)
         self.captioner2 = choice(self.internal_captioners)
 
-        self.incorrect_mode = 0 if correct else 1 + util.sample(self.incorrect_distribution)
+        self.incorrect_mode = 0 if correct else 1 + self.incorrect_distribution.sample()
 
         correct1 = (self.incorrect_mode != 1) and (self.incorrect_mode != 3)  # 1: first incorrect, 3: both incorrect
         correct2 = (self.incorrect_mode != 2) and (self.incorrect_mode != 3)  # 2: second incorrect, 3: both incorrect
@@ -22,7 +22,7 @@ class DisjunctionCaptioner(WorldCaptioner):
             logical_contradiction_rate=logical_contradiction_rate
         )
 
-        self.correct_distribution = util.cumulative_distribution(util.value_or_default(correct_distribution, [1, 1, 1]))
+        self.correct_distribution = util.AliasSampler(util.value_or_default(correct_distribution, [1, 1, 1]))
 
     def set_realizer(self, realizer):
         if not super(DisjunctionCaptioner, self).set_realizer(realizer=realizer):
@@ -48,7 +48,7 @@ class DisjunctionCaptioner(WorldCaptioner):
         self.captioner1 = choice(self.internal_captioners)
         self.captioner2 = choice(self.internal_captioners)
 
-        self.correct_mode = 0 if not correct else 1 + util.sample(self.correct_distribution)
+        self.correct_mode = 0 if not correct else 1 + self.correct_distribution.sample()
 
         correct1 = (self.correct_mode == 1) or (self.correct_mode == 3)  # 1: first correct, 3: both correct
         correct2 = (self.correct_mode == 2) or (self.correct_mode == 3)  # 2: second correct, 3: both correct
@@ -22,7 +22,7 @@ class ExistentialCaptioner(WorldCaptioner):
 
         self.restrictor_captioner = restrictor_captioner
         self.body_captioner = body_captioner
-        self.incorrect_distribution = util.cumulative_distribution(util.value_or_default(incorrect_distribution, [1, 1]))
+        self.incorrect_distribution = util.AliasSampler(util.value_or_default(incorrect_distribution, [1, 1]))
 
     def set_realizer(self, realizer):
         if not super(ExistentialCaptioner, self).set_realizer(realizer=realizer):
@@ -43,7 +43,7 @@ class ExistentialCaptioner(WorldCaptioner):
         if not super(ExistentialCaptioner, self).sample_values(mode=mode, correct=correct, predication=predication):
             return False
 
-        self.incorrect_mode = 0 if correct else 1 + util.sample(self.incorrect_distribution)
+        self.incorrect_mode = 0 if correct else 1 + self.incorrect_distribution.sample()
 
         predication = predication.copy()
 
@@ -24,7 +24,7 @@ class MaxAttributeCaptioner(WorldCaptioner):
 
         self.scope_captioner = scope_captioner
         self.attributes = attributes
-        self.incorrect_distribution = util.cumulative_distribution(util.value_or_default(incorrect_distribution, [1, 1, 1]))
+        self.incorrect_distribution = util.AliasSampler(util.value_or_default(incorrect_distribution, [1, 1, 1]))
 
     def set_realizer(self, realizer):
         if not super(MaxAttributeCaptioner, self).set_realizer(realizer):
@@ -47,7 +47,7 @@ class MaxAttributeCaptioner(WorldCaptioner):
         if not super(MaxAttributeCaptioner, self).sample_values(mode=mode, correct=correct, predication=predication):
             return False
 
-        self.incorrect_mode = 0 if correct else 1 + util.sample(self.incorrect_distribution)
+        self.incorrect_mode = 0 if correct else 1 + self.incorrect_distribution.sample()
 
         self.predtype, self.value = choice(self.attributes)
 
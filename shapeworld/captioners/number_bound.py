@@ -25,7 +25,7 @@ class NumberBoundCaptioner(WorldCaptioner):
 
         self.quantifier_captioner = quantifier_captioner
         self.number_bounds = number_bounds
-        self.incorrect_distribution = util.cumulative_distribution(util.value_or_default(incorrect_distribution, [3, 1, 1, 1]))
+        self.incorrect_distribution = util.AliasSampler(util.value_or_default(incorrect_distribution, [3, 1, 1, 1]))
 
     def set_realizer(self, realizer):
         if not super(NumberBoundCaptioner, self).set_realizer(realizer):
@@ -50,7 +50,7 @@ class NumberBoundCaptioner(WorldCaptioner):
         if not super(NumberBoundCaptioner, self).sample_values(mode=mode, correct=correct, predication=predication):
             return False
 
-        self.incorrect_mode = 0 if correct else 1 + util.sample(self.incorrect_distribution)
+        self.incorrect_mode = 0 if correct else 1 + self.incorrect_distribution.sample()
 
         if not self.quantifier_captioner.sample_values(mode=mode, correct=(self.incorrect_mode != 1), predication=predication):  # 1: incorrect quantifier
             return False
@@ -27,7 +27,7 @@ class QuantifierCaptioner(WorldCaptioner):
         self.restrictor_captioner = restrictor_captioner
         self.body_captioner = body_captioner
         self.quantifiers = quantifiers
-        self.incorrect_distribution = util.cumulative_distribution(util.value_or_default(incorrect_distribution, [1, 1, 2]))
+        self.incorrect_distribution = util.AliasSampler(util.value_or_default(incorrect_distribution, [1, 1, 2]))
 
     def set_realizer(self, realizer):
         if not super(QuantifierCaptioner, self).set_realizer(realizer):
@@ -52,7 +52,7 @@ class QuantifierCaptioner(WorldCaptioner):
         if not super(QuantifierCaptioner, self).sample_values(mode=mode, correct=correct, predication=predication):
             return False
 
-        self.incorrect_mode = 0 if correct else 1 + util.sample(self.incorrect_distribution)
+        self.incorrect_mode = 0 if correct else 1 + self.incorrect_distribution.sample()
 
         self.qtype, self.qrange, self.quantity = choice(self.quantifiers)
 
@@ -41,9 +41,9 @@ class RegularTypeCaptioner(WorldCaptioner):
         if self.incorrect_distribution is None:
             # incorrect mode distribution uniform across attributes
             max_length = max(len(self.shapes), len(self.colors), len(self.textures)) - 1
-            self.incorrect_distribution = util.cumulative_distribution([len(self.shapes) - 1, len(self.colors) - 1, len(self.textures) - 1, max_length])
+            self.incorrect_distribution = util.AliasSampler([len(self.shapes) - 1, len(self.colors) - 1, len(self.textures) - 1, max_length])
         else:
-            self.incorrect_distribution = util.cumulative_distribution(self.incorrect_distribution)
+            self.incorrect_distribution = util.AliasSampler(self.incorrect_distribution)
 
         return True
 
@@ -74,7 +74,7 @@ class RegularTypeCaptioner(WorldCaptioner):
             return False
 
         for _ in range(self.__class__.MAX_SAMPLE_ATTEMPTS):
-            self.incorrect_mode = 0 if correct else 1 + util.sample(self.incorrect_distribution)
+            self.incorrect_mode = 0 if correct else 1 + self.incorrect_distribution.sample()
             if (self.incorrect_mode != 1 or ('shape' in attributes and not predication.redundant(predicate='shape'))) and \
                     (self.incorrect_mode != 2 or ('color' in attributes and not predication.redundant(predicate='color'))) and \
                     (self.incorrect_mode != 3 or ('texture' in attributes and not predication.redundant(predicate='texture'))):
@@ -26,7 +26,7 @@ class RelationCaptioner(WorldCaptioner):
         self.reference_captioner = reference_captioner
         self.comparison_captioner = comparison_captioner
         self.relations = relations
-        self.incorrect_distribution = util.cumulative_distribution(util.value_or_default(incorrect_distribution, [1, 1, 1, 1]))
+        self.incorrect_distribution = util.AliasSampler(util.value_or_default(incorrect_distribution, [1, 1, 1, 1]))
 
     def set_realizer(self, realizer):
         if not super(RelationCaptioner, self).set_realizer(realizer):
@@ -52,7 +52,7 @@ class RelationCaptioner(WorldCaptioner):
         self.predtype, self.value = choice(self.relations)
 
         for _ in range(self.__class__.MAX_SAMPLE_ATTEMPTS):
-            self.incorrect_mode = 0 if correct else 1 + util.sample(self.incorrect_distribution)
+            self.incorrect_mode = 0 if correct else 1 + self.incorrect_distribution.sample()
             if (self.incorrect_mode != 2 or self.predtype in Relation.ternary_relations):
                 # if incorrect comparison but relation not ternary
                 break
@@ -1,3 +1,5 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
 import sys
 from io import BytesIO
@@ -6,15 +8,18 @@ import json
 import pprint
 from math import ceil, sqrt
 import os
-from random import random, randrange, shuffle
+from queue import Empty, Full, Queue
+from random import random, randrange, sample
+from threading import Event, Lock, Thread
+import time
 import numpy as np
 from PIL import Image
-from shapeworld import util
+from shapeworld import model_util, util
 from shapeworld.world import World
 from shapeworld.realizers import CaptionRealizer
 
 
-def dataset(dtype=None, name=None, language=None, config=None):
+def dataset(dtype=None, name=None, language=None, config=None, values=None):
     # explain type = 'load', 'mixer', possibilities, e.g. with ',', or with ';'?
     assert config is None or isinstance(config, dict) or isinstance(config, str)
     assert dtype is None or isinstance(dtype, str)
@@ -47,8 +52,10 @@ def dataset(dtype=None, name=None, language=None, config=None):
             config = json.load(fp=filehandle)
         if load and 'directory' not in config:
             config['directory'] = directory
+    # value projection only for loaded datasets
+    assert values is None or load
     if load:
-        dataset = LoadedDataset(specification=config)
+        dataset = LoadedDataset(specification=config, values=values)
         assert dtype is None or dtype == dataset.type
         assert name is None or name == dataset.name
         assert language is None or language == dataset.language
@@ -91,6 +98,34 @@ def alternatives_type(value_type):
         return value_type, False
 
 
+def encode_image(world_array, image_format='bmp'):
+    if image_format == 'rle':
+        return World.get_rle(world_array=world_array)
+    image = World.get_image(world_array=world_array)
+    image_bytes = BytesIO()
+    image.save(image_bytes, format=image_format)
+    return image_bytes.getvalue()
+
+
+def decode_image(image_bytes, image_format='bmp'):
+    if image_format == 'rle':
+        return World.from_rle(rle_bytes=image_bytes)
+    image = Image.open(BytesIO(image_bytes))
+    return World.from_image(image)
+
+
+def texts_strings(generated, id2word):
+    # per instance its texts as strings, from the text strings if generated, otherwise decoded from the word ids of the
+    # texts, which are indices into the captions if generated as indices
+    if 'texts_str' in generated:
+        return generated['texts_str']
+    texts = np.asarray(generated['texts'], dtype=np.int64)
+    if texts.ndim == 2:
+        texts = np.asarray(generated['caption'], dtype=np.int64)[texts]
+    words = np.asarray(id2word, dtype=object)[texts]
+    return [[' '.join(text) + ' ' for text in instance_texts] for instance_texts in words.tolist()]
+
+
 class Dataset(object):
 
     def __init__(self, world_size, vectors=None, vocabularies=None, language=None):
@@ -110,6 +145,17 @@ class Dataset(object):
                 vocabulary['[UNKNOWN]'] = len(vocabulary)
                 self.vocabularies[name] = vocabulary
         self.language = language
+        self.random_seed = None
+        self.random_part = None
+        self.instance_offsets = dict()
+        self.requested_indices = None
+        # metadata index values per instance of the last generated batch, e.g. number of entities and captioner, so
+        # models are not required for the index
+        self.instance_metadata = None
+        # util.Metrics recording generation counters and timings, if any
+        self.metrics = None
+        # values which are indices into the rows of another value of the batch, as value name -> indexed value name
+        self.index_values = dict()
 
     def __str__(self):
         if self.language is None:
@@ -150,8 +196,17 @@ class Dataset(object):
             specification['vocabularies'] = self.vocabularies
         if self.language:
             specification['language'] = self.language
+        if self.index_values:
+            specification['index_values'] = self.index_values
         return specification
 
+    @property
+    def stats(self):
+        # counters and per-stage timings recorded so far, None if no metrics
+        if self.metrics is None:
+            return None
+        return self.metrics.values()
+
     @property
     def world_shape(self):
         if isinstance(self.world_size, int):
@@ -174,6 +229,39 @@ class Dataset(object):
         else:
             return [word for word, _ in sorted(self.vocabularies[value_type].items(), key=(lambda kv: kv[1]))]
 
+    def set_random_seed(self, seed, part=None):
+        # instance i of a mode is generated from its own stream derived from (seed, mode, part, i)
+        self.random_seed = seed
+        self.random_part = part
+        self.instance_offsets = dict()
+
+    def instance_indices(self, n, mode):
+        if self.requested_indices is not None:
+            indices = self.requested_indices
+            self.requested_indices = None
+            assert len(indices) == n
+            return indices
+        offset = self.instance_offsets.get(mode, 0)
+        self.instance_offsets[mode] = offset + n
+        return range(offset, offset + n)
+
+    def random_generator(self, mode, index, attempt=0):
+        if self.random_seed is None:
+            return np.random
+        else:
+            return np.random.default_rng(util.seed_sequence(self.random_seed, mode, self.random_part, index, *Dataset.attempt_keys(attempt=attempt), 'numpy'))
+
+    def seed_instance(self, mode, index, attempt=0):
+        if self.random_seed is not None:
+            util.set_random_seed(self.random_seed, mode, self.random_part, index, *Dataset.attempt_keys(attempt=attempt))
+        return self.random_generator(mode=mode, index=index, attempt=attempt)
+
+    @staticmethod
+    def attempt_keys(attempt):
+        # instances regenerated after a failed first attempt seeded per attempt, first attempt keys unchanged
+        assert attempt >= 0
+        return () if attempt == 0 else ('retry', attempt)
+
     def zero_batch(self, n, include_model=False, alternatives=False):
         batch = dict()
         for value_name, value_type in self.values.items():
@@ -223,109 +311,78 @@ class Dataset(object):
         while True:
             yield self.generate(n=n, mode=mode, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
 
-    def get_html(self, generated):
-        return None
+    def batch(self, mode, indices, noise_range=None, include_model=False, alternatives=False):
+        # instances are only reproducible if a random seed is set
+        self.requested_indices = list(indices)
+        try:
+            generated = self.generate(n=len(self.requested_indices), mode=mode, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+            # requested indices consumed via instance_indices, otherwise generate ignores them
+            assert self.requested_indices is None, 'per-index generation not supported by {} dataset'.format(self.name)
+        finally:
+            self.requested_indices = None
+        return generated
 
-    def serialize(self, path, generated, additional=None, filename=None, archive=None, concat_worlds=False, html=False):
-        assert not additional or all(value_name not in self.values for value_name in additional)
-        if not os.path.isdir(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
+    def instance(self, mode, index, noise_range=None, include_model=False, alternatives=False):
+        generated = self.batch(mode=mode, indices=(index,), noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+        return {value_name: value[0] for value_name, value in generated.items()}
 
-        with util.Archive(path=path, mode='w', archive=archive) as write_file:
-            for value_name, value in generated.items():
-                if self.values[value_name] == 'skip':
-                    # print(f'Skipping serializing {value_name}')
-                    pass
-                else:
-                    # print(f'Serializing {value_name}')
-                    Dataset.serialize_value(
-                        value=value,
-                        value_name=value_name,
-                        value_type=self.values[value_name],
-                        write_file=write_file,
-                        concat_worlds=concat_worlds,
-                        id2word=self.vocabulary(value_type=self.values[value_name])
-                    )
-                if additional:
-                    for value_name, (value, value_type) in additional.items():
-                        Dataset.serialize_value(
-                            value=value,
-                            value_name=value_name,
-                            value_type=value_type,
-                            write_file=write_file,
-                            concat_worlds=concat_worlds,
-                            id2word=self.vocabulary(value_type=self.values[value_name])
-                        )
-                if html:
-                    html = self.get_html(generated=generated)
-                    assert html is not None
-                    write_file(filename='data.html', value=html)
+    def iterate_range(self, n, mode, start, stop, noise_range=None, include_model=False, alternatives=False):
+        for offset in range(start, stop, n):
+            yield self.batch(mode=mode, indices=range(offset, min(offset + n, stop)), noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+
+    def iterate_shard(self, n, mode, size, num_shards, shard, noise_range=None, include_model=False, alternatives=False):
+        start, stop = util.shard_range(size=size, num_shards=num_shards, shard=shard)
+        return self.iterate_range(n=n, mode=mode, start=start, stop=stop, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+
+    def __getitem__(self, mode):
+        return DatasetMode(dataset=self, mode=mode)
+
+    def get_html(self, generated, image_format='bmp'):
+        return None
+
+    def metadata(self, generated):
+        # per instance the values of the metadata index which are available
+        n = len(next(iter(generated.values())))
+        metadata = [dict() for _ in range(n)]
+        if self.values.get('world_model') == 'model' and 'world_model' in generated:
+            for values, model in zip(metadata, generated['world_model']):
+                if 'entities' in model:
+                    values['entities'] = len(model['entities'])
+        if self.instance_metadata is not None and len(self.instance_metadata) == n:
+            for values, instance_values in zip(metadata, self.instance_metadata):
+                values.update(instance_values)
+        if self.values.get('caption_model') == 'model' and 'caption_model' in generated:
+            for values, model in zip(metadata, generated['caption_model']):
+                if 'component' in model:
+                    values['caption_type'] = model['component']
+        if self.values.get('caption_rpn') == 'rpn' and 'caption_rpn' in generated:
+            # by id, since ids of mixed vocabularies are not contiguous
+            id2symbol = {index: symbol for symbol, index in self.vocabularies['rpn'].items()}
+            for values, rpn, rpn_length in zip(metadata, generated['caption_rpn'], generated['caption_rpn_length']):
+                values['rpn'] = ' '.join(id2symbol[symbol] for symbol in rpn[:rpn_length])
+        if self.values.get('agreement') == 'float' and 'agreement' in generated:
+            for values, agreement in zip(metadata, generated['agreement']):
+                values['agreement'] = float(agreement)
+        return metadata
 
     @staticmethod
-    def serialize_value(value, value_name, value_type, write_file, concat_worlds=False, id2word=None):
-        value_type, alts = alternatives_type(value_type=value_type)
-        if value_type == 'int':
-            if alts:
-                value = '\n'.join(';'.join(str(int(x)) for x in xs) for xs in value) + '\n'
-            else:
-                value = '\n'.join(str(int(x)) for x in value) + '\n'
-            write_file(value_name + '.txt', value)
-        elif value_type == 'float':
-            if alts:
-                value = '\n'.join(';'.join(str(float(x)) for x in xs) for xs in value) + '\n'
-            else:
-                value = '\n'.join(str(float(x)) for x in value) + '\n'
-            write_file(value_name + '.txt', value)
-        elif value_type == 'vector(int)' or value_type == 'vector(float)':
-            if alts:
-                value = '\n'.join(';'.join(','.join(str(x) for x in vector) for vector in vectors) for vectors in value) + '\n'
-            else:
-                value = '\n'.join(','.join(str(x) for x in vector) for vector in value) + '\n'
-            write_file(value_name + '.txt', value)
-        elif value_type == 'world':
-            if concat_worlds:
-                size = ceil(sqrt(len(value)))
-                worlds = []
-                for y in range(ceil(len(value) / size)):
-                    if y < len(value) // size:
-                        worlds.append(np.concatenate([value[y * size + x] for x in range(size)], axis=1))
-                    else:
-                        worlds.append(np.concatenate([value[y * size + x] for x in range(len(value) % size)] + [np.zeros_like(a=value[0]) for _ in range(-len(value) % size)], axis=1))
-                worlds = np.concatenate(worlds, axis=0)
-                image = World.get_image(world_array=worlds)
-                image_bytes = BytesIO()
-                image.save(image_bytes, format='bmp')
-                write_file(value_name + '.bmp', image_bytes.getvalue(), binary=True)
-                image_bytes.close()
-            else:
-                for n in range(len(value)):
-                    image = World.get_image(world_array=value[n])
-                    image_bytes = BytesIO()
-                    image.save(image_bytes, format='bmp')
-                    write_file('{}-{}.bmp'.format(value_name, n), image_bytes.getvalue(), binary=True)
-                    image_bytes.close()
-        elif value_type == 'model':
-            value = json.dumps(obj=value, indent=2, sort_keys=True)
-            write_file(value_name + '.json', value)
-        elif value_type == 'str_list_list':
-            value = '\n'.join(' || '.join(x for x in elem) for elem in value) + '\n'
-            write_file(value_name + '.txt', value)
-        elif value_type == 'str_list_list_list':
-            value = '\n'.join(' || '.join(', '.join(x for x in it) for it in elem) for elem in value) + '\n'
-            write_file(value_name + '.txt', value)
-        elif value_type == 'str_list':
-            value = '\n'.join(x for x in value) + '\n'
-            write_file(value_name + '.txt', value)
-        else:
-            assert id2word
-            if alts:
-                value = '\n\n'.join('\n'.join(' '.join(id2word[word_id] for word_id in words if word_id) for words in words_alts) for words_alts in value) + '\n\n'
-            else:
-                value = '\n'.join(' '.join(id2word[word_id] for word_id in words if word_id) for words in value) + '\n'
-            write_file(value_name + '.txt', value)
+    def captioner_path(captioner_model):
+        # names of the captioner and its selected subcaptioners, e.g. CaptionerMixer/QuantifierCaptioner
+        names = [captioner_model['name']]
+        while 'captioner' in captioner_model:
+            captioner_model = captioner_model['captioner']
+            names.append(captioner_model['name'])
+        return '/'.join(names)
+
+    def serialize(self, path, generated, additional=None, filename=None, archive=None, concat_worlds=False, html=False, storage=None):
+        with self.writer(path=path, num_instances=len(next(iter(generated.values()))), archive=archive, concat_worlds=concat_worlds, html=html, storage=storage) as write:
+            write(generated=generated, additional=additional)
+
+    def writer(self, path, num_instances=None, archive=None, concat_worlds=False, html=False, storage=None, image_format=None, image_threads=1, include_worlds=True, model_format=None):
+        return DatasetWriter(dataset=self, path=path, num_instances=num_instances, archive=archive, concat_worlds=concat_worlds, html=html, storage=storage, image_format=image_format, image_threads=image_threads, include_worlds=include_worlds, model_format=model_format)
 
     @staticmethod
-    def deserialize_value(value_name, value_type, read_file, num_concat_worlds=0, word2id=None):
+    def deserialize_value(value_name, value_type, read_file, num_concat_worlds=0, word2id=None, image_format='bmp', map_images=map, model_format='json'):
         value_type, alts = alternatives_type(value_type=value_type)
         if value_type == 'int':
             value = read_file(value_name + '.txt')
@@ -358,32 +415,31 @@ class Dataset(object):
         elif value_type == 'world':
             if num_concat_worlds:
                 size = ceil(sqrt(num_concat_worlds))
-                image_bytes = read_file(value_name + '.bmp', binary=True)
+                rows = ceil(num_concat_worlds / size)
+                image_bytes = read_file('{}.{}'.format(value_name, image_format), binary=True)
                 assert image_bytes is not None
-                image_bytes = BytesIO(image_bytes)
-                image = Image.open(image_bytes)
-                worlds = World.from_image(image)
-                height = worlds.shape[0] // ceil(num_concat_worlds / size)
-                assert worlds.shape[0] % ceil(num_concat_worlds / size) == 0
+                worlds = decode_image(image_bytes=image_bytes, image_format=image_format)
+                assert worlds.shape[0] % rows == 0 and worlds.shape[1] % size == 0
+                height = worlds.shape[0] // rows
                 width = worlds.shape[1] // size
-                assert worlds.shape[1] % size == 0
-                value = []
-                for y in range(ceil(num_concat_worlds / size)):
-                    for x in range(size if y < num_concat_worlds // size else num_concat_worlds % size):
-                        value.append(worlds[y * height: (y + 1) * height, x * width: (x + 1) * width, :])
+                # split sprite sheet row by row into cells
+                worlds = worlds.reshape(rows, height, size, width, worlds.shape[2]).transpose(0, 2, 1, 3, 4)
+                value = list(worlds.reshape(rows * size, height, width, worlds.shape[4])[:num_concat_worlds])
             else:
-                value = []
-                n = 0
+                # files are read sequentially, images decoded with the given map
+                images_bytes = []
                 while True:
-                    image_bytes = read_file('{}-{}.bmp'.format(value_name, n), binary=True)
+                    image_bytes = read_file('{}-{}.{}'.format(value_name, len(images_bytes), image_format), binary=True)
                     if image_bytes is None:
                         break
-                    image_bytes = BytesIO(image_bytes)
-                    image = Image.open(image_bytes)
-                    value.append(World.from_image(image))
-                    n += 1
+                    images_bytes.append(image_bytes)
+                value = list(map_images(lambda image_bytes: decode_image(image_bytes=image_bytes, image_format=image_format), images_bytes))
             return value
         elif value_type == 'model':
+            if model_format == 'compact':
+                # lazy sequence of models
+                value = read_file(value_name + '.npz', binary=True)
+                return model_util.read_models(models_bytes=value)
             value = read_file(value_name + '.json')
             value = json.loads(s=value)
             return value
@@ -409,41 +465,375 @@ class Dataset(object):
             return value
 
 
+    @staticmethod
+    def column_array(value, value_type):
+        # fixed-dtype array of a column, or None if stored as json
+        value_type, alts = alternatives_type(value_type=value_type)
+        if alts or value_type in ('model', 'str_list', 'str_list_list', 'str_list_list_list'):
+            return None
+        elif value_type == 'float' or value_type == 'vector(float)':
+            return np.asarray(value, dtype=np.float32)
+        elif value_type == 'world':
+            return (np.asarray(value) * 255.0).astype(dtype=np.uint8)
+        else:
+            return np.asarray(value, dtype=np.int32)
+
+    @staticmethod
+    def deserialize_record(record, columns):
+        value = dict()
+        start = 0
+        for value_name, column in columns.items():
+            if column['dtype'] != 'json':
+                dtype = np.dtype(column['dtype'])
+                end = start + dtype.itemsize * util.product(column['shape'])
+                value[value_name] = np.frombuffer(record[start:end], dtype=dtype).reshape(column['shape'])
+                start = end
+        value.update(json.loads(s=bytes(record[start:])))
+        return value
+
+    @staticmethod
+    def deserialize_column(value_name, value_type, column, read_file, read_array):
+        if column['file'].endswith('.json'):
+            value = read_file(column['file'])
+            return json.loads(s=value)
+        elif column['file'].endswith('.npz'):
+            value = read_file(column['file'], binary=True)
+            return model_util.read_models(models_bytes=value)
+        else:
+            value = read_array(column['file'])
+            assert str(value.dtype) == column['dtype'] and list(value.shape) == column['shape']
+            return value
+
+
+class DatasetWriter(object):
+    # appends chunks of generated instances to a part, so memory does not depend on the part size
+
+    def __init__(self, dataset, path, num_instances=None, archive=None, concat_worlds=False, html=False, storage=None, image_format=None, image_threads=1, include_worlds=True, model_format=None):
+        storage = util.value_or_default(storage, 'text')
+        assert storage in ('text', 'npy', 'records')
+        image_format = util.value_or_default(image_format, 'bmp')
+        assert image_format in ('bmp', 'png', 'rle')
+        model_format = util.value_or_default(model_format, 'json')
+        assert model_format in ('json', 'compact')
+        # records contain models as json
+        assert storage != 'records' or model_format == 'json'
+        # records are memory-mapped on loading
+        assert storage != 'records' or archive is None
+        # npy column headers contain the number of instances
+        assert storage != 'npy' or num_instances is not None
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.dataset = dataset
+        self.num_instances = num_instances
+        self.concat_worlds = concat_worlds
+        self.html = html
+        self.storage = storage
+        # without worlds, they are rendered from their models on loading
+        self.include_worlds = include_worlds
+        self.image_format = image_format
+        self.model_format = model_format
+        # order-preserving map of a thread pool, since PIL releases the GIL while encoding
+        self.image_pool = ThreadPoolExecutor(max_workers=image_threads) if image_threads > 1 else None
+        self.map_images = map if self.image_pool is None else self.image_pool.map
+        self.archive = util.Archive(path=path, mode='w', archive=archive)
+        self.num_written = 0
+        self.columns = dict()
+        self.json_files = set()
+        # concatenated images and compact models are only written at the end
+        self.worlds = dict()
+        self.models = dict()
+        self.offsets = [0]
+
+    def __enter__(self):
+        return self.write
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.archive.close()
+            if self.image_pool is not None:
+                self.image_pool.shutdown()
+        return False
+
+    def stream(self, filename):
+        if filename in self.archive.streams:
+            return self.archive.streams[filename]
+        else:
+            return self.archive.open_stream(filename=filename)
+
+    def append_json(self, filename, values, **kwargs):
+        # json list written item by item
+        stream = self.stream(filename=filename)
+        for value in values:
+            stream.write(b',\n' if filename in self.json_files else b'[\n')
+            self.json_files.add(filename)
+            stream.write(json.dumps(obj=value, default=(lambda x: x.tolist()), **kwargs).encode())
+
+    def write(self, generated, additional=None):
+        start = time.perf_counter()
+        assert not additional or all(value_name not in self.dataset.values for value_name in additional)
+        values = [(value_name, value, self.dataset.values[value_name]) for value_name, value in generated.items() if self.dataset.values[value_name] != 'skip' and (self.dataset.values[value_name] != 'world' or self.include_worlds)]
+        if additional:
+            values.extend((value_name, value, value_type) for value_name, (value, value_type) in additional.items())
+        # indices into the rows of the chunk stored as indices into the rows of the part
+        values = [(value_name, (np.asarray(value) + self.num_written if value_name in self.dataset.index_values else value), value_type) for value_name, value, value_type in values]
+        n = len(next(iter(generated.values())))
+        if self.storage == 'records':
+            self.write_records(values=values, n=n)
+        for value_name, value, value_type in values:
+            if self.storage == 'npy':
+                self.write_column(value=value, value_name=value_name, value_type=value_type)
+            elif self.storage == 'text':
+                self.write_value(value=value, value_name=value_name, value_type=value_type)
+        if self.html and self.num_written == 0:
+            # html of the first chunk, with png copies of its worlds unless they are stored as browser images per instance
+            if self.storage == 'text' and self.include_worlds and not self.concat_worlds and self.image_format in ('bmp', 'png'):
+                html = self.dataset.get_html(generated=generated, image_format=self.image_format)
+            else:
+                for value_name, value in generated.items():
+                    if self.dataset.values.get(value_name) == 'world':
+                        images_bytes = self.map_images(lambda world: encode_image(world_array=world, image_format='png'), value)
+                        for i, image_bytes in enumerate(images_bytes):
+                            self.archive.write_file('{}-{}.png'.format(value_name, i), image_bytes, binary=True)
+                html = self.dataset.get_html(generated=generated, image_format='png')
+            assert html is not None
+            self.archive.write_file(filename='data.html', value=html)
+        self.num_written += n
+        if self.dataset.metrics is not None:
+            self.dataset.metrics.record(timings=dict(serialize=(time.perf_counter() - start)))
+
+    def write_value(self, value, value_name, value_type):
+        value_type, alts = alternatives_type(value_type=value_type)
+        if value_type == 'int':
+            if alts:
+                value = '\n'.join(';'.join(str(int(x)) for x in xs) for xs in value) + '\n'
+            else:
+                value = '\n'.join(str(int(x)) for x in value) + '\n'
+            self.stream(filename=(value_name + '.txt')).write(value.encode())
+        elif value_type == 'float':
+            if alts:
+                value = '\n'.join(';'.join(str(float(x)) for x in xs) for xs in value) + '\n'
+            else:
+                value = '\n'.join(str(float(x)) for x in value) + '\n'
+            self.stream(filename=(value_name + '.txt')).write(value.encode())
+        elif value_type == 'vector(int)' or value_type == 'vector(float)':
+            if alts:
+                value = '\n'.join(';'.join(','.join(str(x) for x in vector) for vector in vectors) for vectors in value) + '\n'
+            else:
+                value = '\n'.join(','.join(str(x) for x in vector) for vector in value) + '\n'
+            self.stream(filename=(value_name + '.txt')).write(value.encode())
+        elif value_type == 'world':
+            if self.concat_worlds:
+                self.worlds.setdefault(value_name, list()).extend(value)
+            else:
+                images_bytes = self.map_images(lambda world: encode_image(world_array=world, image_format=self.image_format), value)
+                for n, image_bytes in enumerate(images_bytes):
+                    self.archive.write_file('{}-{}.{}'.format(value_name, self.num_written + n, self.image_format), image_bytes, binary=True)
+        elif value_type == 'model':
+            if self.model_format == 'compact':
+                self.models.setdefault(value_name, list()).append(model_util.encode_models(models=value))
+            else:
+                self.append_json(filename=(value_name + '.json'), values=value, indent=2, sort_keys=True)
+        elif value_type == 'str_list_list':
+            value = '\n'.join(' || '.join(x for x in elem) for elem in value) + '\n'
+            self.stream(filename=(value_name + '.txt')).write(value.encode())
+        elif value_type == 'str_list_list_list':
+            value = '\n'.join(' || '.join(', '.join(x for x in it) for it in elem) for elem in value) + '\n'
+            self.stream(filename=(value_name + '.txt')).write(value.encode())
+        elif value_type == 'str_list':
+            value = '\n'.join(x for x in value) + '\n'
+            self.stream(filename=(value_name + '.txt')).write(value.encode())
+        else:
+            id2word = self.dataset.vocabulary(value_type=value_type)
+            assert id2word
+            if alts:
+                value = '\n\n'.join('\n'.join(' '.join(id2word[word_id] for word_id in words if word_id) for words in words_alts) for words_alts in value) + '\n\n'
+            else:
+                value = '\n'.join(' '.join(id2word[word_id] for word_id in words if word_id) for words in value) + '\n'
+            self.stream(filename=(value_name + '.txt')).write(value.encode())
+
+    def write_column(self, value, value_name, value_type):
+        # fixed-dtype npy column where possible, otherwise json
+        if self.model_format == 'compact' and alternatives_type(value_type=value_type)[0] == 'model':
+            self.models.setdefault(value_name, list()).append(model_util.encode_models(models=value))
+            self.columns[value_name] = dict(file=(value_name + '.npz'))
+            return
+        array = Dataset.column_array(value=value, value_type=value_type)
+        if array is None:
+            self.append_json(filename=(value_name + '.json'), values=value)
+            self.columns[value_name] = dict(file=(value_name + '.json'))
+            return
+        stream = self.stream(filename=(value_name + '.npy'))
+        if value_name not in self.columns:
+            shape = (self.num_instances,) + array.shape[1:]
+            np.lib.format.write_array_header_1_0(stream, dict(descr=np.lib.format.dtype_to_descr(array.dtype), fortran_order=False, shape=shape))
+            self.columns[value_name] = dict(file=(value_name + '.npy'), dtype=str(array.dtype), shape=list(shape))
+        assert str(array.dtype) == self.columns[value_name]['dtype'] and list(array.shape[1:]) == self.columns[value_name]['shape'][1:]
+        stream.write(np.ascontiguousarray(array).tobytes())
+
+    def write_records(self, values, n):
+        # one record per instance: raw bytes of the array values followed by json of the other values
+        arrays = list()
+        objects = list()
+        for value_name, value, value_type in values:
+            array = Dataset.column_array(value=value, value_type=value_type)
+            if array is None:
+                column = dict(dtype='json')
+                objects.append((value_name, value))
+            else:
+                column = dict(dtype=str(array.dtype), shape=list(array.shape[1:]))
+                arrays.append(array)
+            assert self.columns.setdefault(value_name, column) == column
+        stream = self.stream(filename='records.bin')
+        for i in range(n):
+            for array in arrays:
+                stream.write(array[i].tobytes())
+            stream.write(json.dumps(obj={value_name: value[i] for value_name, value in objects}, default=(lambda x: x.tolist())).encode())
+            self.offsets.append(stream.tell())
+
+    def close(self):
+        start = time.perf_counter()
+        assert self.num_instances is None or self.num_written == self.num_instances
+        for filename in self.json_files:
+            self.stream(filename=filename).write(b'\n]')
+        for value_name, value in self.worlds.items():
+            # sprite sheet of cells row by row, last row padded
+            size = ceil(sqrt(len(value)))
+            rows = ceil(len(value) / size)
+            worlds = np.zeros(shape=((rows * size,) + value[0].shape), dtype=value[0].dtype)
+            worlds[:len(value)] = value
+            height, width, channels = value[0].shape
+            worlds = worlds.reshape(rows, size, height, width, channels).transpose(0, 2, 1, 3, 4).reshape(rows * height, size * width, channels)
+            image_bytes = encode_image(world_array=worlds, image_format=self.image_format)
+            self.archive.write_file('{}.{}'.format(value_name, self.image_format), image_bytes, binary=True)
+        for value_name, columns in self.models.items():
+            models_bytes = model_util.write_models(models=model_util.concatenate_models(columns=columns))
+            self.archive.write_file(value_name + '.npz', models_bytes, binary=True)
+        if self.storage == 'records':
+            offsets_bytes = BytesIO()
+            np.save(offsets_bytes, np.asarray(self.offsets, dtype=np.int64), allow_pickle=False)
+            self.archive.write_file('index.npy', offsets_bytes.getvalue(), binary=True)
+            offsets_bytes.close()
+        if self.storage != 'text':
+            header = dict(num_instances=self.num_written, columns=self.columns)
+            self.archive.write_file('header.json', json.dumps(obj=header))
+        self.archive.close()
+        if self.image_pool is not None:
+            self.image_pool.shutdown()
+        if self.dataset.metrics is not None:
+            self.dataset.metrics.record(timings=dict(serialize=(time.perf_counter() - start)))
+
+
+class DatasetMode(object):
+
+    def __init__(self, dataset, mode, noise_range=None, include_model=False, alternatives=False):
+        assert mode in (None, 'train', 'validation', 'test')
+        self.dataset = dataset
+        self.mode = mode
+        self.noise_range = noise_range
+        self.include_model = include_model
+        self.alternatives = alternatives
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            return self.dataset.instance(mode=self.mode, index=index, noise_range=self.noise_range, include_model=self.include_model, alternatives=self.alternatives)
+        elif isinstance(index, slice):
+            assert index.stop is not None
+            indices = range(*index.indices(index.stop))
+        else:
+            indices = index
+        return self.dataset.batch(mode=self.mode, indices=indices, noise_range=self.noise_range, include_model=self.include_model, alternatives=self.alternatives)
+
+
 class LoadedDataset(Dataset):
 
-    def __init__(self, specification):
+    def __init__(self, specification, values=None):
         self._type = specification.pop('type')
         self._name = specification.pop('name')
         self._values = specification.pop('values')
+        # worlds rendered from their models instead of stored
+        self.render_worlds = specification.pop('render_worlds', False)
+        # index values are resolved into the indexed values on loading
+        index_values = specification.pop('index_values', dict())
+        if values is not None:
+            # unrequested values are never read
+            assert all(value_name in self._values for value_name in values)
+            values = set(values)
+            if self.render_worlds:
+                values.update([value_name + '_model' for value_name in values if self._values[value_name] == 'world'])
+            values.update([index_values[value_name] for value_name in values if value_name in index_values])
+            if 'alternatives' in self._values and any(alternatives_type(value_type=self._values[value_name])[1] for value_name in values):
+                values.add('alternatives')
+            self._values = {value_name: value_type for value_name, value_type in self._values.items() if value_name in values}
         self.archive = specification.pop('archive', None)
         self.include_model = specification.pop('include_model', False)
         self.num_concat_worlds = specification.pop('num_concat_worlds', 0)
+        self.image_format = specification.pop('image_format', 'bmp')
+        self.model_format = specification.pop('model_format', 'json')
+        self.image_pool = None
+        self.storage = specification.pop('storage', 'text')
+        self.cache_size = 0  # bytes of decoded parts kept beyond those in use, see set_cache_size
         self.directory = specification.pop('directory')
         self._specification = specification
 
         super(LoadedDataset, self).__init__(world_size=specification.pop('world_size'), vectors=specification.pop('vectors', None), vocabularies=specification.pop('vocabularies', None), language=specification.pop('language', None))
+        self.index_values = index_values
 
         self.per_part = True
         self.part_once = False
         self.parts = dict()
-        for root, dirs, files in os.walk(self.directory):
-            if root == self.directory:
-                assert not files
-                assert len(dirs) <= 4 and 'train' in dirs and 'validation' in dirs and 'test' in dirs and (len(dirs) == 3 or 'tf-records' in dirs)
-            elif root[len(self.directory) + 1:] in ('train', 'validation', 'test', 'tf-records'):
-                mode = root[len(self.directory) + 1:]
-                if dirs:
-                    assert all(d[:4] == 'part' and d[4:].isdigit() for d in dirs)
-                    # print(dirs, files)
-                    assert not files
-                    self.parts[mode] = [os.path.join(root, d) for d in dirs]
-                else:
-                    assert all(f[:4] == 'part' for f in files)
-                    self.parts[mode] = [os.path.join(root, f) for f in files]
+        self.part_offsets = dict()
+        # parts not yet chosen per mode if part_once, chosen from prefetch threads too
+        self.remaining_parts = dict()
+        self.remaining_parts_lock = Lock()
+        manifest_path = os.path.join(self.directory, 'manifest.json')
+        if os.path.isfile(manifest_path):
+            # parts and instance counts from the dataset manifest
+            with open(manifest_path, 'r') as filehandle:
+                manifest = json.load(fp=filehandle)
+            for mode, parts in manifest['parts'].items():
+                self.parts[mode] = [os.path.join(self.directory, part['path']) for part in parts]
+                self.part_offsets[mode] = np.cumsum([0] + [part['num_instances'] for part in parts])
+        else:
+            # record storage requires instance counts
+            assert self.storage != 'records'
+            for root, dirs, files in os.walk(self.directory):
+                if root == self.directory:
+                    # files written alongside the parts, e.g. left without manifest by an interrupted write
+                    unknown = [f for f in files if f not in ('manifest.json', 'metadata.sqlite', 'metadata.sqlite-journal', 'specification.json')]
+                    assert not unknown, 'unknown files in dataset directory without manifest: {}'.format(', '.join(sorted(unknown)))
+                    assert len(dirs) <= 4 and 'train' in dirs and 'validation' in dirs and 'test' in dirs and (len(dirs) == 3 or 'tf-records' in dirs)
+                elif root[len(self.directory) + 1:] in ('train', 'validation', 'test', 'tf-records'):
+                    mode = root[len(self.directory) + 1:]
+                    if dirs:
+                        assert all(d[:4] == 'part' and d[4:].isdigit() for d in dirs)
+                        # print(dirs, files)
+                        assert not files
+                        self.parts[mode] = [os.path.join(root, d) for d in dirs]
+                    else:
+                        assert all(f[:4] == 'part' for f in files)
+                        self.parts[mode] = [os.path.join(root, f) for f in files]
         assert self.parts
-        self.mode = None
-        self.loaded = {value_name: [] for value_name, value_type in self.values.items() if value_type != 'model' or self.include_model}
-        self.num_instances = 0
+        self.loaded_values = [value_name for value_name, value_type in self.values.items() if value_type != 'skip' and (value_type not in ('model', 'alts(model)') or self.include_model) and (value_type != 'world' or not self.render_worlds)]
+        if self.render_worlds:
+            self.rendered_values = [value_name for value_name, value_type in self.values.items() if value_type == 'world']
+            assert self.include_model and all(value_name + '_model' in self.loaded_values for value_name in self.rendered_values)
+        else:
+            self.rendered_values = []
+        self.world_dtype = np.dtype(np.float32)
+        # per mode: loaded parts as key -> (path, part), remaining instances as shuffled (key, row) pairs
+        self.loaded = dict()
+        self.order = dict()
+        self.num_loaded = 0
+        # decoded parts by path, least recently used first
+        self.part_cache = OrderedDict()
+        self.part_cache_lock = Lock()
+        # memory-mapped records, offsets and columns by part path
+        self.shards = dict()
+        self.prefetch_parts = 0
+        self.prefetch_threads = 0
+        self.prefetchers = dict()
 
     @property
     def name(self):
@@ -471,72 +861,403 @@ class LoadedDataset(Dataset):
             else:
                 raise
 
+    def zero_batch(self, n, include_model=False, alternatives=False):
+        # index values resolved into the indexed values, e.g. (n, number_texts, caption_size) texts
+        batch = super(LoadedDataset, self).zero_batch(n, include_model=include_model, alternatives=alternatives)
+        for value_name, indexed_name in self.index_values.items():
+            if value_name in batch:
+                batch[value_name] = np.zeros(shape=(batch[value_name].shape + self.vector_shape(indexed_name)), dtype=batch[indexed_name].dtype)
+        return batch
+
     def get_records_paths(self):
         assert 'tf-records' in self.parts
         return self.parts['tf-records']
 
-    def generate(self, n, mode=None, noise_range=None, include_model=False, alternatives=False):
+    def num_instances(self, mode):
+        assert mode in self.part_offsets, 'instance counts of mode {} require a dataset manifest'.format(mode)
+        return int(self.part_offsets[mode][-1])
+
+    def batch(self, mode, indices, noise_range=None, include_model=False, alternatives=False):
+        # random access via the instance counts per part, records read one by one, other parts decoded (npy: memory-mapped) and cached
         assert not include_model or self.include_model
-        if not self.per_part:
-            self.mode = None if mode else 'train'
-        while self.mode != mode or self.num_instances < n:
-            if self.mode != mode:
-                self.mode = mode
-                self.loaded = {value_name: [] for value_name, value_type in self.values.items() if value_type not in ('model', 'alts(model)') or self.include_model}
-            parts = self.parts[mode]
-            part = randrange(len(parts))
-            path = parts.pop(part) if self.part_once else parts[part]
-            self.num_instances = 0
-            with util.Archive(path=path, mode='r', archive=self.archive) as read_file:
-                for value_name, value in self.loaded.items():
-                    if self.values[value_name] == 'skip':
-                        # print(f'Skipping deserializing {value_name}')
-                        pass
+        indices = np.asarray(indices, dtype=np.int64)
+        assert np.all(indices >= 0) and np.all(indices < self.num_instances(mode=mode))
+        part_offsets = self.part_offsets[mode]
+        parts = np.searchsorted(part_offsets, indices, side='right') - 1
+        batch = self.zero_batch(len(indices), include_model=include_model, alternatives=alternatives)
+        models = {value_name: [None] * len(indices) for value_name in self.rendered_values}
+        if self.storage == 'records':
+            for i, (index, part) in enumerate(zip(indices, parts)):
+                instance = self.read_record(path=self.parts[mode][part], row=(index - part_offsets[part]))
+                for value_name, value in batch.items():
+                    if value_name in models:
+                        models[value_name][i] = instance[value_name + '_model']
+                    elif value_name in self.index_values:
+                        for k, row in enumerate(instance[value_name]):
+                            value[i][k] = self.read_record(path=self.parts[mode][part], row=row)[self.index_values[value_name]]
+                    elif self.values[value_name] == 'world':
+                        value[i] = instance[value_name].astype(dtype=np.float32) / 255.0
                     else:
-                        # print(f'Deserializing {value_name}')
-                        value.extend(Dataset.deserialize_value(
-                            value_name=value_name,
-                            value_type=self.values[value_name],
-                            read_file=read_file,
-                            num_concat_worlds=self.num_concat_worlds,
-                            word2id=self.vocabularies.get(self.values[value_name])
-                        ))
-                        if self.num_instances:
-                            assert len(value) == self.num_instances
-                        else:
-                            self.num_instances = len(value)
+                        value[i] = instance[value_name]
+        else:
+            for part in np.unique(parts):
+                positions = np.nonzero(parts == part)[0]
+                self.fill_batch(batch=batch, models=models, part=self.load_cached_part(path=self.parts[mode][part]), positions=positions, rows=(indices[positions] - part_offsets[part]))
+            self.evict_parts()
+        for value_name, value_models in models.items():
+            self.render(models=value_models, worlds=batch[value_name])
+        if noise_range is not None and noise_range > 0.0 and len(indices) > 0:
+            self.add_noise(batch=batch, noise_range=noise_range, rng=self.random_generator(mode=mode, index=indices[0]))
+        return self.convert_worlds(batch=batch)
+
+    def read_record(self, path, row):
+        if path not in self.shards:
+            archive = util.Archive(path=path, mode='r')
+            with archive as read_file:
+                columns = json.loads(s=read_file('header.json'))['columns']
+                offsets = archive.read_array('index.npy')
+            records = np.memmap(os.path.join(path, 'records.bin'), dtype=np.uint8, mode='r')
+            self.shards[path] = (records, offsets, columns)
+        records, offsets, columns = self.shards[path]
+        return Dataset.deserialize_record(record=records[offsets[row]: offsets[row + 1]], columns=columns)
+
+    def generate(self, n, mode=None, noise_range=None, include_model=False, alternatives=False):
+        assert not include_model or self.include_model
+        if self.storage == 'records':
+            # global shuffle over all instances of the mode
+            if not self.per_part or mode not in self.order:
+                self.order[mode] = np.zeros(shape=(0,), dtype=np.int64)
+            while len(self.order[mode]) < n:
+                self.order[mode] = np.concatenate([self.order[mode], np.random.permutation(self.num_instances(mode=mode))])
+            indices = self.order[mode][:n]
+            self.order[mode] = self.order[mode][n:]
+            return self.batch(mode=mode, indices=indices, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+        if not self.per_part or mode not in self.order:
+            self.loaded[mode] = dict()
+            self.order[mode] = np.zeros(shape=(0, 2), dtype=np.int64)
+        loaded = self.loaded[mode]
+        while len(self.order[mode]) < n:
+            key = self.num_loaded
+            self.num_loaded += 1
+            loaded[key] = self.next_part(mode=mode)
+            num_instances = len(loaded[key][1][self.loaded_values[0]])
+            assert all(len(value) == num_instances for value in loaded[key][1].values())
+            rows = np.stack([np.full(shape=(num_instances,), fill_value=key), np.arange(num_instances)], axis=1)
+            self.order[mode] = np.random.permutation(np.concatenate([self.order[mode], rows]))
+        selected = self.order[mode][:n]
+        self.order[mode] = self.order[mode][n:]
         batch = self.zero_batch(n, include_model=include_model, alternatives=alternatives)
-        for i in range(n):
-            index = randrange(self.num_instances)
-            self.num_instances -= 1
-            for value_name, value_type in self.values.items():
-                if value_type in ('model', 'alts(model)') and not self.include_model:
-                    continue
-                if value_type == 'skip':
-                    continue
-                value = self.loaded[value_name].pop(index)
-                if value_type in self.vocabularies:
-                    batch[value_name][i][:len(value)] = value
-                elif value_type not in ('model', 'alts(model)') or include_model:
-                    batch[value_name][i] = value
+        models = {value_name: [None] * n for value_name in self.rendered_values}
+        for key in np.unique(selected[:, 0]):
+            positions = np.nonzero(selected[:, 0] == key)[0]
+            rows = selected[positions, 1]
+            self.fill_batch(batch=batch, models=models, part=loaded[key][1], positions=positions, rows=rows)
+        # release parts without remaining instances
+        self.loaded[mode] = {key: loaded[key] for key in np.unique(self.order[mode][:, 0])}
+        self.evict_parts()
+        for value_name, value_models in models.items():
+            self.render(models=value_models, worlds=batch[value_name])
         if noise_range is not None and noise_range > 0.0:
-            for value_name, value_type in self.values.items():
-                if value_type == 'world':
-                    noise = np.random.normal(loc=0.0, scale=noise_range, size=((n,) + self.world_shape))
-                    mask = (noise < -2.0 * noise_range) + (noise > 2.0 * noise_range)
-                    while np.any(a=mask):
-                        noise -= mask * noise
-                        noise += mask * np.random.normal(loc=0.0, scale=noise_range, size=((n,) + self.world_shape))
-                        mask = (noise < -2.0 * noise_range) + (noise > 2.0 * noise_range)
-                    worlds = batch[value_name]
-                    worlds += noise
-                    np.clip(worlds, a_min=0.0, a_max=1.0, out=worlds)
+            self.add_noise(batch=batch, noise_range=noise_range, rng=self.random_generator(mode=mode, index=self.instance_indices(n=n, mode=mode)[0]))
+        return self.convert_worlds(batch=batch)
+
+    def fill_batch(self, batch, models, part, positions, rows):
+        # ascending rows for locality of memory-mapped columns
+        sort = np.argsort(rows)
+        positions = positions[sort]
+        rows = rows[sort]
+        for value_name, value_models in models.items():
+            column = part[value_name + '_model']
+            for i, row in zip(positions, rows):
+                value_models[i] = column[row]
+        for value_name, value in batch.items():
+            if value_name in models:
+                continue
+            column = part[value_name]
+            if value_name in self.index_values:
+                indexed = part[self.index_values[value_name]]
+                for i, row in zip(positions, rows):
+                    for k, indexed_row in enumerate(column[row]):
+                        value[i][k][:len(indexed[indexed_row])] = indexed[indexed_row]
+            elif isinstance(value, np.ndarray) and isinstance(column, np.ndarray):
+                column = np.take(column, rows, axis=0)
+                if self.values[value_name] == 'world' and column.dtype == np.uint8:
+                    column = column.astype(dtype=np.float32) / 255.0
+                value[positions] = column
+            elif self.values[value_name] in self.vocabularies:
+                for i, row in zip(positions, rows):
+                    value[i][:len(column[row])] = column[row]
+            else:
+                for i, row in zip(positions, rows):
+                    value[i] = column[row]
+
+    def query(self, mode, where=None, parameters=()):
+        # (part path, row) of instances matching an sql condition on the metadata index written by generate.py,
+        # with columns entities, captioner, caption_type, rpn and agreement, e.g. where='entities >= ? AND captioner LIKE ?'
+        index_path = os.path.join(self.directory, 'metadata.sqlite')
+        assert os.path.isfile(index_path)
+        with util.MetadataIndex(path=index_path) as index:
+            matches = index.query(mode=mode, where=where, parameters=parameters)
+        return [(os.path.join(self.directory, part), row) for part, row in matches]
+
+    def select(self, mode, where=None, parameters=(), noise_range=None, include_model=False, alternatives=False):
+        # all matching instances in index order, parts without matching instances are never read
+        assert not include_model or self.include_model
+        matches = self.query(mode=mode, where=where, parameters=parameters)
+        if self.storage == 'records':
+            part_indices = {path: n for n, path in enumerate(self.parts[mode])}
+            indices = [self.part_offsets[mode][part_indices[path]] + row for path, row in matches]
+            return self.batch(mode=mode, indices=indices, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+        batch = self.zero_batch(len(matches), include_model=include_model, alternatives=alternatives)
+        models = {value_name: [None] * len(matches) for value_name in self.rendered_values}
+        paths = np.array([path for path, _ in matches], dtype=object)
+        rows = np.array([row for _, row in matches], dtype=np.int64)
+        for path in util.unique_list(paths.tolist()):
+            positions = np.nonzero(paths == path)[0]
+            self.fill_batch(batch=batch, models=models, part=self.load_cached_part(path=path), positions=positions, rows=rows[positions])
+        self.evict_parts()
+        for value_name, value_models in models.items():
+            self.render(models=value_models, worlds=batch[value_name])
+        if noise_range is not None and noise_range > 0.0 and len(matches) > 0:
+            self.add_noise(batch=batch, noise_range=noise_range, rng=self.random_generator(mode=mode, index=0))
+        return self.convert_worlds(batch=batch)
+
+    def set_world_format(self, world_size=None, dtype=None):
+        # other world sizes only if worlds are rendered from their models
+        if world_size is not None:
+            assert self.render_worlds or world_size == self.world_size
+            self.world_size = world_size if isinstance(world_size, int) else tuple(world_size)
+        if dtype is not None:
+            self.world_dtype = np.dtype(dtype)
+
+    def render(self, models, worlds):
+        size = util.Point(self.world_shape[1], self.world_shape[0])
+        for world_array, model in zip(worlds, models):
+            world = World.from_model(model=model)
+            world.size = size
+            world_array[:] = world.get_array()
+
+    def convert_worlds(self, batch):
+        if self.world_dtype == np.float32:
+            return batch
+        for value_name, value_type in self.values.items():
+            if value_type == 'world':
+                if self.world_dtype == np.uint8:
+                    batch[value_name] = np.rint(batch[value_name] * 255.0).astype(dtype=np.uint8)
+                else:
+                    batch[value_name] = batch[value_name].astype(dtype=self.world_dtype)
         return batch
 
-    def get_html(self, generated):
+    def add_noise(self, batch, noise_range, rng):
+        for value_name, value_type in self.values.items():
+            if value_type == 'world':
+                worlds = batch[value_name]
+                noise = rng.normal(loc=0.0, scale=noise_range, size=worlds.shape)
+                mask = (noise < -2.0 * noise_range) + (noise > 2.0 * noise_range)
+                while np.any(a=mask):
+                    noise -= mask * noise
+                    noise += mask * rng.normal(loc=0.0, scale=noise_range, size=worlds.shape)
+                    mask = (noise < -2.0 * noise_range) + (noise > 2.0 * noise_range)
+                worlds += noise
+                np.clip(worlds, a_min=0.0, a_max=1.0, out=worlds)
+
+    def choose_part(self, mode):
+        if not self.part_once:
+            parts = self.parts[mode]
+            return parts[randrange(len(parts))] if parts else None
+        # parts in the order of part_offsets kept for batch and select
+        with self.remaining_parts_lock:
+            if mode not in self.remaining_parts:
+                self.remaining_parts[mode] = list(self.parts[mode])
+            parts = self.remaining_parts[mode]
+            if not parts:
+                return None
+            return parts.pop(randrange(len(parts)))
+
+    def next_part(self, mode):
+        if self.prefetch_parts == 0:
+            path = self.choose_part(mode=mode)
+            return path, self.load_cached_part(path=path)
+        if mode not in self.prefetchers:
+            self.prefetchers[mode] = PartPrefetcher(choose_part=(lambda: self.choose_part(mode=mode)), load_part=self.load_cached_part, num_parts=self.prefetch_parts, num_threads=self.prefetch_threads)
+        return self.prefetchers[mode].get()
+
+    def load_cached_part(self, path):
+        assert path is not None  # no parts left
+        with self.part_cache_lock:
+            if path in self.part_cache:
+                self.part_cache.move_to_end(path)
+                return self.part_cache[path][0]
+        part = self.load_part(path=path)
+        # memory-mapped columns are not counted
+        size = sum(value.nbytes for value in part.values() if isinstance(value, np.ndarray) and not isinstance(value, np.memmap))
+        with self.part_cache_lock:
+            self.part_cache[path] = (part, size)
+        return part
+
+    def evict_parts(self):
+        # least recently used parts first, parts in use by any mode are kept
+        in_use = set(path for loaded in self.loaded.values() for path, _ in loaded.values())
+        with self.part_cache_lock:
+            size = sum(size for _, size in self.part_cache.values())
+            for path in list(self.part_cache):
+                if size <= self.cache_size:
+                    break
+                if path not in in_use:
+                    size -= self.part_cache.pop(path)[1]
+
+    def start_prefetching(self, parts=2, threads=1):
+        # decode up to the given number of parts per mode in background threads
+        assert parts > 0 and threads > 0
+        self.stop_prefetching()
+        self.prefetch_parts = parts
+        self.prefetch_threads = threads
+
+    def set_cache_size(self, size):
+        # bytes of decoded parts kept beyond those in use, e.g. to revisit parts via batch or select
+        assert size >= 0
+        self.cache_size = size
+        self.evict_parts()
+
+    def set_image_threads(self, threads):
+        # decode the images of a part in a thread pool
+        if self.image_pool is not None:
+            self.image_pool.shutdown()
+        self.image_pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    def stop_prefetching(self):
+        for prefetcher in self.prefetchers.values():
+            prefetcher.stop()
+        self.prefetchers = dict()
+        self.prefetch_parts = 0
+        self.prefetch_threads = 0
+
+    def prefetch_statistics(self):
+        return {mode: prefetcher.statistics() for mode, prefetcher in self.prefetchers.items()}
+
+    def load_part(self, path):
+        # values as arrays (rows of an instance) where possible, otherwise as lists
+        archive = util.Archive(path=path, mode='r', archive=self.archive)
+        with archive as read_file:
+            if self.storage == 'npy':
+                header = json.loads(s=read_file('header.json'))
+            part = dict()
+            for value_name in self.loaded_values:
+                value_type = self.values[value_name]
+                if self.storage == 'npy':
+                    # rows of memory-mapped columns are only read when used
+                    part[value_name] = Dataset.deserialize_column(
+                        value_name=value_name,
+                        value_type=value_type,
+                        column=header['columns'][value_name],
+                        read_file=read_file,
+                        read_array=archive.read_array
+                    )
+                    continue
+                value = Dataset.deserialize_value(
+                    value_name=value_name,
+                    value_type=value_type,
+                    read_file=read_file,
+                    num_concat_worlds=self.num_concat_worlds,
+                    word2id=self.vocabularies.get(value_type),
+                    image_format=self.image_format,
+                    map_images=(map if self.image_pool is None else self.image_pool.map),
+                    model_format=self.model_format
+                )
+                if value_type == 'world':
+                    value = np.stack(value)
+                elif value_type == 'int':
+                    value = np.asarray(value, dtype=np.int32)
+                elif value_type == 'float':
+                    value = np.asarray(value, dtype=np.float32)
+                elif value_type == 'vector(int)' or value_type == 'vector(float)':
+                    value = np.asarray(value, dtype=(np.int32 if value_type == 'vector(int)' else np.float32))
+                elif value_type in self.vocabularies:
+                    padded = np.zeros(shape=((len(value),) + self.vector_shape(value_name)), dtype=np.int32)
+                    for row, words in zip(padded, value):
+                        row[:len(words)] = words
+                    value = padded
+                part[value_name] = value
+        return part
+
+    def get_html(self, generated, image_format='bmp'):
         module = import_module('shapeworld.datasets.{}.{}'.format(self.type, self.name))
         dclass = module.dataset
-        return dclass.get_html(self, generated=generated)
+        return dclass.get_html(self, generated=generated, image_format=image_format)
+
+
+class PartPrefetcher(object):
+
+    def __init__(self, choose_part, load_part, num_parts, num_threads):
+        self.choose_part = choose_part
+        self.load_part = load_part
+        self.queue = Queue(maxsize=num_parts)
+        self.lock = Lock()
+        self.stopped = Event()
+        self.parts_loaded = 0
+        self.parts_consumed = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.threads = [Thread(target=self.run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                with self.lock:
+                    path = self.choose_part()
+                if path is None:
+                    part = None
+                else:
+                    part = (path, self.load_part(path=path))
+                    with self.lock:
+                        self.parts_loaded += 1
+            except Exception as exception:
+                # passed on to the consumer instead of silently ending the thread
+                part = exception
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(part, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if part is None or isinstance(part, Exception):
+                break
+
+    def get(self):
+        try:
+            part = self.queue.get_nowait()
+        except Empty:
+            before = time.time()
+            part = self.queue.get()
+            wait_time = time.time() - before
+            self.waits += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        if isinstance(part, Exception):
+            raise part
+        assert part is not None  # no parts left
+        self.parts_consumed += 1
+        return part
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+
+    def statistics(self):
+        return dict(
+            queue_depth=self.queue.qsize(),
+            queue_capacity=self.queue.maxsize,
+            parts_loaded=self.parts_loaded,
+            parts_consumed=self.parts_consumed,
+            waits=self.waits,
+            wait_time=self.wait_time,
+            max_wait_time=self.max_wait_time,
+            mean_wait_time=(self.wait_time / self.parts_consumed if self.parts_consumed else 0.0)
+        )
 
 
 class DatasetMixer(Dataset):
@@ -559,20 +1280,23 @@ class DatasetMixer(Dataset):
         for name in datasets[0].vocabularies:
             vocabularies[name] = sorted(set(word for dataset in datasets for word in dataset.vocabularies[name]))
         language = datasets[0].language
-        super(DatasetMixer, self).__init__(None, vectors=vectors, vocabularies=vocabularies, language=language)
+        self.datasets = datasets
+        super(DatasetMixer, self).__init__(world_size=datasets[0].world_size, vectors=vectors, vocabularies=vocabularies, language=language)
         for dataset in datasets:
             dataset.vectors = self.vectors
             dataset.vocabularies = self.vocabularies
-        self.datasets = datasets
+        # index values of the datasets remapped to the mixed batch on generation
+        assert all(dataset.index_values == datasets[0].index_values for dataset in datasets)
+        self.index_values = dict(datasets[0].index_values)
         self.consistent_batches = consistent_batches
         assert not distribution or len(distribution) == len(datasets)
         distribution = util.value_or_default(distribution, [1] * len(datasets))
-        self.distribution = util.cumulative_distribution(distribution)
+        self.distribution = util.AliasSampler(distribution)
         assert bool(train_distribution) == bool(validation_distribution) == bool(test_distribution)
-        assert not train_distribution or len(train_distribution) == len(validation_distribution) == len(test_distribution) == len(self.distribution)
-        self.train_distribution = util.cumulative_distribution(util.value_or_default(train_distribution, distribution))
-        self.validation_distribution = util.cumulative_distribution(util.value_or_default(validation_distribution, distribution))
-        self.test_distribution = util.cumulative_distribution(util.value_or_default(test_distribution, distribution))
+        assert not train_distribution or len(train_distribution) == len(validation_distribution) == len(test_distribution) == len(datasets)
+        self.train_distribution = util.AliasSampler(util.value_or_default(train_distribution, distribution))
+        self.validation_distribution = util.AliasSampler(util.value_or_default(validation_distribution, distribution))
+        self.test_distribution = util.AliasSampler(util.value_or_default(test_distribution, distribution))
 
     @property
     def type(self):
@@ -582,33 +1306,61 @@ class DatasetMixer(Dataset):
     def values(self):
         return self.datasets[0].values
 
-    @property
-    def world_size(self):
-        return self.datasets[0].world_size
+    def set_random_seed(self, seed, part=None):
+        super(DatasetMixer, self).set_random_seed(seed=seed, part=part)
+        for n, dataset in enumerate(self.datasets):
+            dataset.set_random_seed(seed=seed, part='{}/{}'.format(part, n))
 
-    def generate(self, n, mode=None, noise_range=None, include_model=False, alternatives=False):
+    def plan_batch(self, n, mode=None):
+        # instance indices and the dataset index of each instance, sampled at once so generation can be grouped by dataset
         if mode is None:
             distribution = self.distribution
-        if mode == 'train':
+        elif mode == 'train':
             distribution = self.train_distribution
         elif mode == 'validation':
             distribution = self.validation_distribution
         elif mode == 'test':
             distribution = self.test_distribution
+        indices = self.instance_indices(n=n, mode=mode)
         if self.consistent_batches:
-            dataset = util.sample(distribution, self.datasets)
-            return dataset.generate(n=n, mode=mode, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+            indices = list(indices)
+            uniforms = [self.random_generator(mode=mode, index=indices[0]).random()] * n
+        elif self.random_seed is None:
+            uniforms = None
         else:
-            batch = self.zero_batch(n, include_model=include_model, alternatives=alternatives)
-            for i in range(n):
-                dataset = util.sample(distribution, self.datasets)
-                generated = dataset.generate(n=1, mode=mode, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
-                for value_name, value_type in self.values.items():
-                    value = generated[value_name][0]
-                    if value_type in self.vocabularies:
-                        batch[value_name][i][:len(value)] = value
-                    else:
-                        batch[value_name][i] = value
+            indices = list(indices)
+            uniforms = [self.random_generator(mode=mode, index=index).random() for index in indices]
+        assignment = distribution.sample_batch(n=n, uniforms=uniforms)
+        return indices, assignment
+
+    def generate(self, n, mode=None, noise_range=None, include_model=False, alternatives=False):
+        indices, assignment = self.plan_batch(n=n, mode=mode)
+        if self.consistent_batches:
+            dataset = self.datasets[assignment[0]]
+            generated = dataset.batch(mode=mode, indices=indices, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+            self.instance_metadata = dataset.instance_metadata
+            return generated
+        batch = self.zero_batch(n, include_model=include_model, alternatives=alternatives)
+        instance_metadata = [dict() for _ in range(n)]
+        for d, dataset in enumerate(self.datasets):
+            positions = np.nonzero(assignment == d)[0]
+            if len(positions) == 0:
+                continue
+            generated = dataset.batch(mode=mode, indices=[indices[i] for i in positions], noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+            if dataset.instance_metadata is not None:
+                for i, instance_values in zip(positions, dataset.instance_metadata):
+                    instance_metadata[i] = instance_values
+            for value_name, value in batch.items():
+                generated_value = generated[value_name]
+                if value_name in self.index_values:
+                    # indices into the rows of the dataset batch
+                    generated_value = positions[np.asarray(generated_value, dtype=np.int64)]
+                if isinstance(value, np.ndarray):
+                    value[positions] = generated_value
+                else:
+                    for i, instance_value in zip(positions, generated_value):
+                        value[i] = instance_value
+        self.instance_metadata = instance_metadata
         return batch
 
 
@@ -641,16 +1393,28 @@ class ClassificationDataset(Dataset):
         raise NotImplementedError
 
     def generate(self, n, mode=None, noise_range=None, include_model=False, alternatives=False):
+        start = time.perf_counter()
+        timer = util.StageTimer(prefix='generate/', enabled=(self.metrics is not None))
+        world_resamples = 0  # for metrics
         batch = self.zero_batch(n, include_model=include_model, alternatives=alternatives)
-        for i in range(n):
+        instance_metadata = [None] * n
+        for i, index in enumerate(self.instance_indices(n=n, mode=mode)):
+            rng = self.seed_instance(mode=mode, index=index)
             self.world_generator.initialize(mode=mode)
 
             while True:
                 world = self.world_generator()
                 if world is not None:
                     break
+                world_resamples += 1
+            timer.stage('world_generation')
+            instance_metadata[i] = dict(entities=len(world.entities))
+
+            batch['world'][i] = world.get_array()
+            timer.stage('rendering')
+            World.add_noise(world_array=batch['world'][i], noise_range=noise_range, rng=rng)
+            timer.stage('noise')
 
-            batch['world'][i] = world.get_array(noise_range=noise_range)
             if include_model:
                 batch['world_model'][i] = world.model()
             c = None
@@ -661,13 +1425,18 @@ class ClassificationDataset(Dataset):
                     batch['classification'][i][c] = 1.0
             if not self.multi_class:
                 assert c is not None
+            timer.stage('classification')
+
+        if self.metrics is not None:
+            self.metrics.record(counters=dict(batches=1, instances=n, world_resamples=world_resamples), timings=dict(timer.timings, generate=(time.perf_counter() - start)))
+        self.instance_metadata = instance_metadata
         return batch
 
-    def get_html(self, generated):
+    def get_html(self, generated, image_format='bmp'):
         classifications = generated['classification']
         data_html = list()
         for n, classification in enumerate(classifications):
-            data_html.append('<div class="instance"><div class="world"><img src="world-{world}.bmp" alt="world-{world}.bmp"></div><div class="num"><p><b>({num})</b></p></div><div class="classification"><p>'.format(world=n, num=(n + 1)))
+            data_html.append('<div class="instance"><div class="world"><img src="world-{world}.{image_format}" alt="world-{world}.{image_format}"></div><div class="num"><p><b>({num})</b></p></div><div class="classification"><p>'.format(image_format=image_format, world=n, num=(n + 1)))
             comma = False
             for c, count in enumerate(classification):
                 if count == 0.0:
@@ -693,6 +1462,7 @@ class ClassificationDataset(Dataset):
 class CaptionAgreementDataset(Dataset):
 
     INITIALIZE_CAPTIONER = 100
+    REALIZE_ATTEMPTS = 10
 
     def __init__(self, world_generator, world_captioner, caption_size, vocabulary, correct_ratio=None, train_correct_ratio=None, validation_correct_ratio=None, test_correct_ratio=None, caption_realizer=None, language=None):
         assert isinstance(caption_size, int) and caption_size > 0
@@ -745,8 +1515,12 @@ class CaptionAgreementDataset(Dataset):
         else:
             correct_ratio = self.correct_ratio
 
+        start = time.perf_counter()
+        timer = util.StageTimer(prefix='generate/', enabled=(self.metrics is not None))
         captioners_proposed = list()
         captioners_used = list()
+        # for metrics
+        world_resamples = caption_resamples = captioner_initializations = captioner_reinitializations = captioner_rejections = 0
 
         rpn2id = self.vocabularies['rpn']
         unknown = rpn2id['[UNKNOWN]']
@@ -754,123 +1528,128 @@ class CaptionAgreementDataset(Dataset):
 
         batch = self.zero_batch(n, include_model=include_model, alternatives=alternatives)
         captions = [None] * n
-        for i in range(n):
-            # print(i, end=', ', flush=True)
-            correct = random() < correct_ratio
-            resample = 0
-            while True:
-                self.world_generator.initialize(mode=mode)
-                if resample % self.__class__.INITIALIZE_CAPTIONER == 0:
-                    if resample // self.__class__.INITIALIZE_CAPTIONER >= 1:
-                        # print('resample captioner')
-                        # print(self.world_captioner.correct, self.world_captioner.model())
-                        # exit(0)
-                        pass
-                    while not self.world_captioner.initialize(mode=mode, correct=correct):
-                        # print('initialize false')
-                        # assert False
-                        pass
-                    captioner_model = self.world_captioner.model()
-                    if captioner_model not in captioners_proposed:
-                        captioners_proposed.append(captioner_model)
-                    # print(json.dumps(obj=self.world_captioner.model(), indent=2, sort_keys=True))
-                    # print(self.world_captioner.captioner, self.world_captioner.correct)
-
-                resample += 1
-
+        captioner_paths = [None] * n
+        instance_metadata = [None] * n
+        attempts = [0] * n
+        instances = list(enumerate(self.instance_indices(n=n, mode=mode)))
+        while True:
+            for i, index in instances:
+                rng = self.seed_instance(mode=mode, index=index, attempt=attempts[i])
+                if attempts[i] == 0:
+                    correct = random() < correct_ratio
+                else:
+                    # resampled after realizer failure with the same agreement
+                    correct = bool(batch['agreement'][i])
+                    batch['caption_rpn'][i][:] = 0
+                resample = 0
                 while True:
-                    world = self.world_generator()
-                    if world is not None:
+                    self.world_generator.initialize(mode=mode)
+                    timer.stage('world_generation')
+                    if resample % self.__class__.INITIALIZE_CAPTIONER == 0:
+                        captioner_initializations += 1
+                        if resample > 0:
+                            captioner_reinitializations += 1
+                        while not self.world_captioner.initialize(mode=mode, correct=correct):
+                            captioner_rejections += 1
+                        captioner_model = self.world_captioner.model()
+                        if captioner_model not in captioners_proposed:
+                            captioners_proposed.append(captioner_model)
+                        timer.stage('captioner_initialization')
+
+                    resample += 1
+
+                    while True:
+                        world = self.world_generator()
+                        if world is not None:
+                            break
+                        world_resamples += 1
+                    timer.stage('world_generation')
+
+                    caption = self.world_captioner(world=world)
+                    timer.stage('captioning')
+                    if caption is not None:
                         break
-
-                caption = self.world_captioner(world=world)
-                '''Testing variability of captions'''
-               # print(f'20 captions generated for image {i}')
-               # cap_eg = caption
-               # caps = []
-               # for _ in range(20):
-               #     self.world_captioner.initialize(mode=mode, correct=correct)
-               #     cap_eg = self.world_captioner(world=world)
-               #     try:
-               #         cap = self.caption_realizer.realize(captions=[cap_eg])
-               #         cap = ' '.join([word for word in cap[0]])
-               #     except:
-               #         print("DMR realizer assertion error")
-               #         cap = ""
-               #     caps.append(cap)
-               # caps = set(caps)
-               # print(f'Num distinct captions: {len(caps)}\nCaptions: {caps}')
-               # print("==============================================")
-                if caption is not None:
-                    break
-                else:
-                    # print('captioner failed')
-                    pass
-
-            if captioner_model not in captioners_used:
-                captioners_used.append(captioner_model)
-
-            captions[i] = caption
-
-            batch['world'][i] = world.get_array(noise_range=noise_range)
-            batch['agreement'][i] = float(correct)
-
-            rpn = caption.reverse_polish_notation()
-            assert len(rpn) <= rpn_size
-            for k, rpn_symbol in enumerate(rpn):
-                assert rpn_symbol in rpn2id
-                batch['caption_rpn'][i][k] = rpn2id.get(rpn_symbol, unknown)
-            batch['caption_rpn_length'][i] = len(rpn)
-
-            if include_model:
-                batch['world_model'][i] = world.model()
-                batch['caption_model'][i] = caption.model()
+                    caption_resamples += 1
+
+                if captioner_model not in captioners_used:
+                    captioners_used.append(captioner_model)
+
+                captions[i] = caption
+                captioner_paths[i] = Dataset.captioner_path(captioner_model=captioner_model)
+                instance_metadata[i] = dict(entities=len(world.entities), captioner=captioner_paths[i], caption_type=str(caption))
+
+                batch['world'][i] = world.get_array()
+                timer.stage('rendering')
+                World.add_noise(world_array=batch['world'][i], noise_range=noise_range, rng=rng)
+                timer.stage('noise')
+                batch['agreement'][i] = float(correct)
+
+                rpn = caption.reverse_polish_notation()
+                assert len(rpn) <= rpn_size
+                for k, rpn_symbol in enumerate(rpn):
+                    assert rpn_symbol in rpn2id
+                    batch['caption_rpn'][i][k] = rpn2id.get(rpn_symbol, unknown)
+                batch['caption_rpn_length'][i] = len(rpn)
+
+                if include_model:
+                    batch['world_model'][i] = world.model()
+                    batch['caption_model'][i] = caption.model()
+                timer.stage('encoding')
+
+            timer.stage('encoding')
+            # realizer stages recorded in the same metrics
+            self.caption_realizer.metrics = self.metrics
+            realized = self.caption_realizer.realize(captions=[captions[i] for i, _ in instances])
+            timer.stage('realization')
+            for (i, _), caption in zip(instances, realized):
+                captions[i] = caption
+            instances = [instance for instance, caption in zip(instances, realized) if caption is None]
+            if not instances:
+                break
+            for i, index in instances:
+                attempts[i] += 1
+                assert attempts[i] < self.__class__.REALIZE_ATTEMPTS, 'realizer failed on {} attempts for instance {} ({})'.format(attempts[i], index, mode)
 
         word2id = self.vocabularies['language']
         unknown = word2id['[UNKNOWN]']
         caption_size = self.vector_shape('caption')[0]
 
-        unused_words = set(word2id)  # for assert
-        unused_words.remove('')
-        unused_words.remove('[UNKNOWN]')
         missing_words = set()  # for assert
         max_caption_size = caption_size  # for assert
 
-        captions = self.caption_realizer.realize(captions=captions)
+        realization_failures = 0
         for i, caption in enumerate(captions):
             if len(caption) > caption_size:
                 if len(caption) > max_caption_size:
                     max_caption_size = len(caption)
+                realization_failures += 1
                 continue
+            missing = False
             for k, word in enumerate(caption):
-                if word in word2id:
-                    unused_words.discard(word)
-                else:
+                if word not in word2id:
                     missing_words.add(word)
+                    missing = True
                     continue
                 batch['caption'][i][k] = word2id.get(word, unknown)
             batch['caption_length'][i] = len(caption)
+            realization_failures += missing
+        timer.stage('encoding')
+
+        if self.metrics is not None:
+            # captioner usage per captioner path
+            counters = Counter('captioner:' + captioner_path for captioner_path in captioner_paths)
+            self.metrics.record(
+                counters=dict(counters, batches=1, instances=n, world_resamples=world_resamples, caption_resamples=caption_resamples, captioner_initializations=captioner_initializations, captioner_reinitializations=captioner_reinitializations, captioner_rejections=captioner_rejections, captioners_proposed=len(captioners_proposed), captioners_used=len(captioners_used), realization_failures=realization_failures),
+                timings=dict(timer.timings, generate=(time.perf_counter() - start))
+            )
 
-        if len(captioners_used) < len(captioners_proposed):
-            # print('More captioner models proposed than used: {} > {}'.format(len(captioners_proposed), len(captioners_used)))
-            # for captioner_model in captioners_proposed:
-            #     if captioner_model not in captioners_used:
-            #         print(json.dumps(obj=captioner_model, indent=2, sort_keys=True))
-            pass
-
-        # if len(unused_words) > 0:
-        #     print('Words unused in vocabulary: \'{}\''.format('\', \''.join(sorted(unused_words))))
-        # if max_caption_size < caption_size:
-        #     print('Caption size smaller than max size: {} < {}'.format(max_caption_size, caption_size))
-        if len(missing_words) > 0:
-            print('Words missing in vocabulary: \'{}\''.format('\', \''.join(sorted(missing_words))))
-        if max_caption_size > caption_size:
-            print('Caption size exceeds max size: {} > {}'.format(max_caption_size, caption_size))
-        assert not missing_words and max_caption_size <= caption_size
+        assert not missing_words, 'words missing in vocabulary: \'{}\''.format('\', \''.join(sorted(missing_words)))
+        assert max_caption_size <= caption_size, 'caption size exceeds max size: {} > {}'.format(max_caption_size, caption_size)
 
+        self.instance_metadata = instance_metadata
         return batch
 
-    def get_html(self, generated):
+    def get_html(self, generated, image_format='bmp'):
         id2word = self.vocabulary(value_type='language')
         captions = generated['caption']
         caption_lengths = generated['caption_length']
@@ -883,7 +1662,8 @@ class CaptionAgreementDataset(Dataset):
                 agreement = 'incorrect'
             else:
                 agreement = 'ambiguous'
-            data_html.append('<div class="{agreement}"><div class="world"><img src="world-{world}.bmp" alt="world-{world}.bmp"></div><div class="num"><p><b>({num})</b></p></div><div class="caption"><p>{caption}</p></div></div>'.format(
+            data_html.append('<div class="{agreement}"><div class="world"><img src="world-{world}.{image_format}" alt="world-{world}.{image_format}"></div><div class="num"><p><b>({num})</b></p></div><div class="caption"><p>{caption}</p></div></div>'.format(
+                image_format=image_format,
                 agreement=agreement,
                 world=n,
                 num=(n + 1),
@@ -898,82 +1678,210 @@ class CaptionAgreementDataset(Dataset):
         return html
 
 
+class CaptionBank(object):
+    # ring buffer of captions across batches, with signature id of the set of prediction items and item indicators
+
+    def __init__(self, size, caption_length):
+        self.size = size
+        self.captions = np.zeros(shape=(size, caption_length), dtype=np.int32)
+        self.captions_str = [None] * size
+        self.signatures = np.zeros(shape=(size,), dtype=np.int64)
+        self.items = np.zeros(shape=(size, 0), dtype=bool)
+        self.signature_ids = dict()
+        self.item_ids = dict()
+        self.num_entries = 0
+        self.position = 0
+        self.num_filled = 0  # instances generated only for the bank
+
+    def encode(self, pred_items):
+        signatures = np.array([self.signature_ids.setdefault(frozenset(items), len(self.signature_ids)) for items in pred_items], dtype=np.int64)
+        item_ids = [[self.item_ids.setdefault(item, len(self.item_ids)) for item in items] for items in pred_items]
+        items = np.zeros(shape=(len(pred_items), len(self.item_ids)), dtype=bool)
+        for row, ids in zip(items, item_ids):
+            row[ids] = True
+        return signatures, items
+
+    def add(self, captions, captions_str, pred_items):
+        # oldest entries are overwritten, returns the entries, signatures and item indicators of the added captions
+        assert len(captions) <= self.size
+        signatures, items = self.encode(pred_items=pred_items)
+        if items.shape[1] > self.items.shape[1]:
+            self.items = np.pad(self.items, ((0, 0), (0, items.shape[1] - self.items.shape[1])))
+        entries = (self.position + np.arange(len(captions))) % self.size
+        self.captions[entries] = captions
+        self.signatures[entries] = signatures
+        self.items[entries] = items
+        for entry, caption_str in zip(entries.tolist(), captions_str):
+            self.captions_str[entry] = caption_str
+        self.position = (self.position + len(captions)) % self.size
+        self.num_entries = min(self.num_entries + len(captions), self.size)
+        return entries, signatures, items
+
+    def sample(self, valid, num_samples):
+        # per row distinct valid entries in random order, via the smallest random keys
+        assert np.all(np.count_nonzero(valid, axis=1) >= num_samples)
+        if num_samples == 0:
+            return np.zeros(shape=(valid.shape[0], 0), dtype=np.int64)
+        keys = np.random.random(size=valid.shape)
+        keys[~valid] = 2.0
+        entries = np.argpartition(keys, num_samples - 1, axis=1)[:, :num_samples]
+        order = np.argsort(np.take_along_axis(keys, entries, axis=1), axis=1)
+        return np.take_along_axis(entries, order, axis=1)
+
+
 class TextSelectionDataset(CaptionAgreementDataset):
 
     INITIALIZE_CAPTIONER = 100
 
-    def __init__(self, world_generator, world_captioner, caption_size, vocabulary, correct_ratio=None, train_correct_ratio=None, validation_correct_ratio=None, test_correct_ratio=None, caption_realizer=None, language=None, number_texts=10):
+    def __init__(self, world_generator, world_captioner, caption_size, vocabulary, correct_ratio=None, train_correct_ratio=None, validation_correct_ratio=None, test_correct_ratio=None, caption_realizer=None, language=None, number_texts=10, caption_bank_size=None, index_texts=False):
         '''All initially generated captions should agree with the image. Distractors randomly selected as non identical descriptions of other images'''
+        # texts as (n, number_texts) indices into the batch captions, stored as indices into the captions of the part and
+        # resolved into captions on loading, strings only decoded for html
+        assert not index_texts or caption_bank_size is None
+        self.index_texts = index_texts
         super(TextSelectionDataset, self).__init__(world_generator, world_captioner, caption_size, vocabulary, correct_ratio=1.0, train_correct_ratio=1.0, validation_correct_ratio=1.0, test_correct_ratio=1.0, caption_realizer=caption_realizer, language=language)
         self.number_texts = number_texts
+        # distractors from a bank of captions across batches per mode instead of from the batch only
+        assert caption_bank_size is None or caption_bank_size >= number_texts
+        self.caption_bank_size = caption_bank_size
+        self.caption_banks = dict()
+        if index_texts:
+            self.vectors['texts'] = number_texts
+            self.index_values = dict(texts='caption')
         vocab = self.vocabularies['language']
-        self.idx2word = {}
+        self.id2word = np.empty(shape=(len(vocab),), dtype=object)
         for k, v in vocab.items():
-            self.idx2word[v] = k
+            self.id2word[v] = k
 
     @property
     def values(self):
-        return dict(world='world', world_model='model', caption='language', caption_length='int', caption_rpn='rpn', caption_rpn_length='int', caption_model='model', agreement='float', pred_items='str_list_list', caption_str = 'str_list', texts='skip', texts_str='str_list_list', target='int')
+        return self.texts_values(dict(world='world', world_model='model', caption='language', caption_length='int', caption_rpn='rpn', caption_rpn_length='int', caption_model='model', agreement='float', pred_items='str_list_list', caption_str = 'str_list', texts='skip', texts_str='str_list_list', target='int'))
+
+    def texts_values(self, values):
+        # only indices are stored if texts are indices
+        if self.index_texts:
+            values.update(texts='vector(int)', texts_str='skip', caption_str='skip', pred_items='skip')
+        return values
 
     def idx_2_captions(self, captions):
-        captions_str = []
-        for i in range(captions.shape[0]):
-            caption = ""
-            for j in range(captions.shape[1]):
-                caption += self.idx2word[captions[i][j]] + " "
-            captions_str.append(caption)
-        return captions_str
+        # vectorized lookup through the vocabulary array, padding included
+        words = self.id2word[np.asarray(captions, dtype=np.int64)]
+        return [' '.join(caption) + ' ' for caption in words.tolist()]
 
     def generate(self, n, mode=None, noise_range=None, include_model=False, alternatives=False):
-        print(f'\nBatch size: {n}, Number of texts: {self.number_texts}')
-        batch = super(TextSelectionDataset, self).generate(n, mode=mode, noise_range=noise_range, include_model=include_model, alternatives=alternatives)
+        # models required for the prediction items of distractor selection, only returned if requested
+        batch = super(TextSelectionDataset, self).generate(n, mode=mode, noise_range=noise_range, include_model=True, alternatives=alternatives)
         assert np.sum(batch['agreement']) == batch['agreement'].shape[0]
-        batch = self.add_caption_lists(batch, n)
-        print('================ Example prediction items, caption, and final texts  =================')
-        for i in range(min(10, n)):
-            print(f'i: {i}, pred items: {batch["pred_items"][i]}, caption: {batch["caption_str"][i]}\ntexts: {batch["texts_str"][i]}')
+        start = time.perf_counter()
+        batch = self.add_caption_lists(batch, n, mode=mode)
+        if self.metrics is not None:
+            self.metrics.record(timings=dict(select_texts=(time.perf_counter() - start)))
+        if not include_model:
+            batch = {value_name: value for value_name, value in batch.items() if alternatives_type(value_type=self.values[value_name])[0] != 'model'}
         return batch
 
-    def add_caption_lists(self, batch, n):
+    def add_caption_lists(self, batch, n, mode=None):
+        # prediction items are kept in the batch even if not stored
+        if 'pred_items' not in batch:
+            batch['pred_items'] = [[] for _ in range(n)]
         batch = self.extract_prediction_items(batch, n)
-        max_len = batch['caption'].shape[1]
-        '''Get indices of other texts'''
-        '''There must be enough data'''
-        assert n >= 10 * self.number_texts
-        idxs = np.zeros((n, self.number_texts)).astype(int)
-        print(f'Batch targets shape: {batch["target"].shape}')
-        for i, item in enumerate(batch['pred_items']):
-            idxs[i] = self.get_caption_idxs(i, item, batch['pred_items'])
-            batch['target'][i] = np.where(idxs[i]==i)[0]
-            #print(idxs[i])
-            #print(batch['target'][i])
-        print("Selection of text idxs...")
-        print(idxs[:10])
-        batch['texts'] = np.zeros((n, self.number_texts, max_len))
-        print(f'Batch texts shape: {batch["texts"].shape}')
+        '''Get indices of other texts, into the batch or the caption bank'''
+        if self.caption_bank_size is None:
+            idxs, targets = self.select_texts(batch['pred_items'])
+        else:
+            batch['caption_str'] = self.idx_2_captions(batch['caption'])
+            idxs, targets = self.select_bank_texts(batch, n, mode=mode)
+        batch['target'][:] = targets
+        if self.index_texts:
+            batch['texts'][:] = idxs
+            return batch
+        if self.caption_bank_size is None:
+            '''Convert captions to strings, once per caption'''
+            batch['caption_str'] = self.idx_2_captions(batch['caption'])
+            captions = batch['caption']
+            captions_str = batch['caption_str']
+        else:
+            captions = self.caption_banks[mode].captions
+            captions_str = self.caption_banks[mode].captions_str
+        assert len(batch['caption_str']) == n
         '''Get relevant texts given indices'''
+        batch['texts'] = captions[idxs]
         for i in range(n):
-            batch['texts'][i] = batch['caption'][idxs[i]]
-            captions = self.idx_2_captions(batch['texts'][i])
-            batch['texts_str'][i].extend(captions)
-        '''Convert captions to strings'''
-        batch['caption_str'] = self.idx_2_captions(batch['caption'])
-        assert len(batch['caption_str']) == n
+            batch['texts_str'][i].extend(captions_str[idx] for idx in idxs[i])
         return batch
 
-    def get_caption_idxs(self, i, item, pred_items):
-        idxs = [i]
-        n = len(pred_items)
-        candidate_idxs = np.random.randint(0, n, size=self.number_texts * 2).tolist()
-        while len(idxs) < self.number_texts:
-           if len(candidate_idxs) == 0:
-               candidate_idxs = np.random.randint(0, n, size=self.number_texts * 2).tolist()
-           idx = candidate_idxs.pop()
-           if (idx != i) and (set(pred_items[idx]) != set(item)):
-               idxs.append(idx)
-        shuffle(idxs)
-        idxs = np.asarray(idxs).astype(int)
-        return idxs
+    def set_random_seed(self, seed, part=None):
+        # caption banks start empty per part, so distractors do not depend on previously generated parts
+        super(TextSelectionDataset, self).set_random_seed(seed=seed, part=part)
+        self.caption_banks = dict()
+
+    def place_targets(self, own, distractors):
+        # own index at a random target position among the distractors
+        n = len(own)
+        targets = np.random.randint(0, self.number_texts, size=n)
+        is_target = (np.arange(self.number_texts) == targets[:, None])
+        idxs = np.zeros((n, self.number_texts), dtype=np.int64)
+        idxs[is_target] = own
+        idxs[~is_target] = distractors.reshape(-1)
+        return idxs, targets
+
+    def select_bank_texts(self, batch, n, mode):
+        # batch captions added to the bank of the mode, which is filled with further instances if too few distractors are valid
+        if mode not in self.caption_banks:
+            self.caption_banks[mode] = CaptionBank(size=self.caption_bank_size, caption_length=batch['caption'].shape[1])
+        bank = self.caption_banks[mode]
+        assert n <= bank.size
+        own, signatures, items = bank.add(captions=batch['caption'], captions_str=batch['caption_str'], pred_items=[self.prediction_keys(items) for items in batch['pred_items']])
+        while True:
+            valid = self.distractor_mask(signatures=signatures, items=items, bank=bank)
+            if np.all(np.count_nonzero(valid, axis=1) >= self.number_texts - 1):
+                break
+            assert bank.num_entries < bank.size, 'too few distractors in full caption bank of size {}'.format(bank.size)
+            self.fill_caption_bank(bank=bank, n=min(bank.size - bank.num_entries, 10 * self.number_texts), mode=mode)
+            if self.metrics is not None:
+                self.metrics.record(counters=dict(caption_bank_fills=1))
+        distractors = bank.sample(valid=valid, num_samples=(self.number_texts - 1))
+        return self.place_targets(own=own, distractors=distractors)
+
+    def fill_caption_bank(self, bank, n, mode):
+        # instances from their own seed stream, so the instance indices of the mode are not advanced, and instance
+        # metadata of the requested batch is kept
+        instance_metadata = self.instance_metadata
+        self.requested_indices = ['bank-{}'.format(index) for index in range(bank.num_filled, bank.num_filled + n)]
+        bank.num_filled += n
+        generated = super(TextSelectionDataset, self).generate(n, mode=mode, include_model=True)
+        self.instance_metadata = instance_metadata
+        generated = self.extract_prediction_items(generated, n)
+        bank.add(captions=generated['caption'], captions_str=self.idx_2_captions(generated['caption']), pred_items=[self.prediction_keys(items) for items in generated['pred_items']])
+
+    def prediction_keys(self, items):
+        # hashable prediction items
+        return items
+
+    def distractor_mask(self, signatures, items, bank):
+        # per instance the bank entries with other prediction items
+        return bank.signatures[:bank.num_entries] != signatures[:, None]
+
+    def select_texts(self, pred_items):
+        # per instance its own index at a random target position, and distractors with other prediction items from the
+        # same batch, so the distractor pool of generate.py is one chunk
+        signatures = self.prediction_signatures(pred_items)
+        n = len(signatures)
+        # instances grouped by signature, distractors sampled from the instances outside the group
+        order = np.argsort(signatures, kind='stable')
+        sizes = np.bincount(signatures)
+        starts = np.cumsum(sizes) - sizes
+        size = sizes[signatures][:, None]
+        start = starts[signatures][:, None]
+        assert np.all(size < n), 'no distractor with other prediction items'
+        positions = np.random.randint(0, n - size, size=(n, self.number_texts - 1))
+        positions += (positions >= start) * size
+        return self.place_targets(own=np.arange(n), distractors=order[positions])
+
+    def prediction_signatures(self, pred_items):
+        # equal integer signature for instances with equal sets of prediction items
+        signatures = dict()
+        return np.array([signatures.setdefault(frozenset(items), len(signatures)) for items in pred_items], dtype=np.int64)
 
     def get_prediction_item(self, caption_model):
         items = []
@@ -1006,13 +1914,14 @@ class TextSelectionDataset(CaptionAgreementDataset):
             batch['pred_items'][i].extend(pred_items)
         return batch
 
-    def get_html(self, generated):
+    def get_html(self, generated, image_format='bmp'):
         id2word = self.vocabulary(value_type='language')
         captions = generated['caption']
         caption_lengths = generated['caption_length']
-        texts_lists = generated['texts_str']
+        texts_lists = texts_strings(generated=generated, id2word=id2word)
         agreements = generated['agreement']
-        pred_items = generated['pred_items']
+        # not stored if texts are indices
+        pred_items = generated.get('pred_items', [()] * len(captions))
         targets = generated['target']
         data_html = list()
         for n, (caption, texts, agreement, caption_length, pred, t) in enumerate(zip(captions, texts_lists,  agreements, caption_lengths, pred_items, targets)):
@@ -1030,7 +1939,8 @@ class TextSelectionDataset(CaptionAgreementDataset):
             text = 'Texts: '
             for t in texts:
                 text += t + ", "
-            data_html.append('<div class="{agreement}"><div class="world"><img src="world-{world}.bmp" alt="world-{world}.bmp"></div><div class="num"><p><b>({num})</b></p></div><div class="caption"><p>{pred_item}</p><p>{caption}</p><p>{text}</p></div></div>'.format(
+            data_html.append('<div class="{agreement}"><div class="world"><img src="world-{world}.{image_format}" alt="world-{world}.{image_format}"></div><div class="num"><p><b>({num})</b></p></div><div class="caption"><p>{pred_item}</p><p>{caption}</p><p>{text}</p></div></div>'.format(
+                image_format=image_format,
                 agreement=agreement,
                 world=n,
                 num=(n + 1),
@@ -1053,7 +1963,7 @@ class TextSelectionMultiShapeDataset(TextSelectionDataset):
     
     @property
     def values(self):
-        return dict(world='world', world_model='model', caption='language', caption_length='int', caption_rpn='rpn', caption_rpn_length='int', caption_model='model', agreement='float', pred_items='str_list_list_list', caption_str = 'str_list', texts='skip', texts_str='str_list_list', target='int')
+        return self.texts_values(dict(world='world', world_model='model', caption='language', caption_length='int', caption_rpn='rpn', caption_rpn_length='int', caption_model='model', agreement='float', pred_items='str_list_list_list', caption_str = 'str_list', texts='skip', texts_str='str_list_list', target='int'))
 
 
     def extract_prediction_items(self, batch, n):
@@ -1072,34 +1982,55 @@ class TextSelectionMultiShapeDataset(TextSelectionDataset):
         assert len(items) > 0
         return items
     
-    def get_caption_idxs(self, i, item, pred_items):
-        idxs = [i]
+    def select_texts(self, pred_items):
+        # inverted index from (shape, color) items to the instances containing them, built once per batch
         n = len(pred_items)
-        candidate_idxs = np.random.randint(0, n, size=self.number_texts * 2).tolist()
-        while len(idxs) < self.number_texts:
-           if len(candidate_idxs) == 0:
-               candidate_idxs = np.random.randint(0, n, size=self.number_texts * 2).tolist()
-           idx = candidate_idxs.pop()
-           flag = True
-           if (idx == i):
-               flag = False
-           for p in pred_items[idx]:
-               for it in item:
-                   if set(p) == set(it):
-                       flag = False
-           if flag:
-               idxs.append(idx)
-        shuffle(idxs)
-        idxs = np.asarray(idxs).astype(int)
-        return idxs
-    
-    def get_html(self, generated):
+        item_ids = dict()
+        instance_items = [sorted(set(item_ids.setdefault(frozenset(item), len(item_ids)) for item in items)) for items in pred_items]
+        # per item the set of instances containing it, as bitset over the batch
+        postings = np.zeros((len(item_ids), n), dtype=bool)
+        for i, items in enumerate(instance_items):
+            postings[items, i] = True
+        postings = np.packbits(postings, axis=1)
+        popcounts = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.int64)
+        num_distractors = self.number_texts - 1
+        distractors = np.zeros((n, num_distractors), dtype=np.int64)
+        for i, items in enumerate(instance_items):
+            # distinct distractors sampled from the instances not sharing an item, which excludes the instance itself
+            excluded = np.bitwise_or.reduce(postings[items], axis=0)
+            num_valid = n - int(popcounts[excluded].sum())
+            assert num_valid >= num_distractors, 'only {} of {} instances without items of instance {}, {} distractors required'.format(num_valid, n, i, num_distractors)
+            if num_valid * 4 >= n:
+                # rejection sampling against the bitset if most draws are valid
+                selected = list()
+                while len(selected) < num_distractors:
+                    candidates = np.random.randint(0, n, size=(2 * num_distractors * n // num_valid))
+                    candidates = candidates[((excluded[candidates >> 3] >> (7 - (candidates & 7))) & 1) == 0]
+                    for candidate in candidates.tolist():
+                        if candidate not in selected:
+                            selected.append(candidate)
+                distractors[i] = selected[:num_distractors]
+            else:
+                valid = np.flatnonzero(np.unpackbits(~excluded, count=n))
+                distractors[i] = valid[sample(range(num_valid), num_distractors)]
+        return self.place_targets(own=np.arange(n), distractors=distractors)
+
+    def prediction_keys(self, items):
+        return [frozenset(item) for item in items]
+
+    def distractor_mask(self, signatures, items, bank):
+        # per instance the bank entries without shared (shape, color) items
+        shared = np.dot(items.astype(np.int32), bank.items[:bank.num_entries, :items.shape[1]].T.astype(np.int32))
+        return shared == 0
+
+    def get_html(self, generated, image_format='bmp'):
         id2word = self.vocabulary(value_type='language')
         captions = generated['caption']
         caption_lengths = generated['caption_length']
-        texts_lists = generated['texts_str']
+        texts_lists = texts_strings(generated=generated, id2word=id2word)
         agreements = generated['agreement']
-        pred_items = generated['pred_items']
+        # not stored if texts are indices
+        pred_items = generated.get('pred_items', [()] * len(captions))
         targets = generated['target']
         data_html = list()
         for n, (caption, texts, agreement, caption_length, pred, t) in enumerate(zip(captions, texts_lists,  agreements, caption_lengths, pred_items, targets)):
@@ -1120,7 +2051,8 @@ class TextSelectionMultiShapeDataset(TextSelectionDataset):
             text = 'Texts: '
             for t in texts:
                 text += t + ", "
-            data_html.append('<div class="{agreement}"><div class="world"><img src="world-{world}.bmp" alt="world-{world}.bmp"></div><div class="num"><p><b>({num})</b></p></div><div class="caption"><p>{pred_item}</p><p>{caption}</p><p>{text}</p></div></div>'.format(
+            data_html.append('<div class="{agreement}"><div class="world"><img src="world-{world}.{image_format}" alt="world-{world}.{image_format}"></div><div class="num"><p><b>({num})</b></p></div><div class="caption"><p>{pred_item}</p><p>{caption}</p><p>{text}</p></div></div>'.format(
+                image_format=image_format,
                 agreement=agreement,
                 world=n,
                 num=(n + 1),
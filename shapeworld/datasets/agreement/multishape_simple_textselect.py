@@ -16,7 +16,9 @@ class MultishapeSimpleTextselect(TextSelectionMultiShapeDataset):
         caption_size=6,
         vocabulary=('.', 'a', 'an', 'blue', 'circle', 'cross', 'cyan', 'ellipse', 'gray', 'green', 'is', 'magenta', 'pentagon', 'rectangle', 'red', 'semicircle', 'shape', 'square', 'there', 'triangle', 'yellow'),
         language=None,
-        number_texts=10
+        number_texts=10,
+        caption_bank_size=None,
+        index_texts=False
     ):
 
         world_generator = RandomAttributesGenerator(
@@ -40,7 +42,9 @@ class MultishapeSimpleTextselect(TextSelectionMultiShapeDataset):
             caption_size=caption_size,
             vocabulary=vocabulary,
             language=language,
-            number_texts=number_texts
+            number_texts=number_texts,
+            caption_bank_size=caption_bank_size,
+            index_texts=index_texts
         )
 
 
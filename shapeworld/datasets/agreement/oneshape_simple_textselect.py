@@ -12,7 +12,9 @@ class OneshapeSimpleTextselect(TextSelectionDataset):
         caption_size=6,
         vocabulary=('.', 'a', 'an', 'blue', 'circle', 'cross', 'cyan', 'ellipse', 'gray', 'green', 'is', 'magenta', 'pentagon', 'rectangle', 'red', 'semicircle', 'shape', 'square', 'there', 'triangle', 'yellow'),
         language=None,
-        number_texts=10, 
+        number_texts=10,
+        caption_bank_size=None,
+        index_texts=False
     ):
 
         world_generator = RandomAttributesGenerator(
@@ -35,7 +37,9 @@ class OneshapeSimpleTextselect(TextSelectionDataset):
             caption_size=caption_size,
             vocabulary=vocabulary,
             language=language, 
-            number_texts=number_texts
+            number_texts=number_texts,
+            caption_bank_size=caption_bank_size,
+            index_texts=index_texts
         )
 
 
@@ -12,7 +12,9 @@ class OneshapeTextselect(TextSelectionDataset):
         caption_size=9,
         vocabulary=('.', 'a', 'an', 'angular', 'asymmetric', 'blue', 'circle', 'cross', 'cyan', 'ellipse', 'gray', 'green', 'is', 'magenta', 'pentagon', 'rectangle', 'red', 'round', 'semicircle', 'shape', 'square', 'symmetric', 'there', 'triangle', 'yellow'),
         language=None,
-        number_texts=10
+        number_texts=10,
+        caption_bank_size=None,
+        index_texts=False
     ):
 
         world_generator = RandomAttributesGenerator(
@@ -56,7 +58,9 @@ class OneshapeTextselect(TextSelectionDataset):
             caption_size=caption_size,
             vocabulary=vocabulary,
             language=language,
-            number_texts=number_texts
+            number_texts=number_texts,
+            caption_bank_size=caption_bank_size,
+            index_texts=index_texts
         )
 
 
@@ -87,14 +87,14 @@ class CLEVR(Dataset):
                     batch['answer'][i] = self.answers.index('[UNKNOWN]')
         return batch
 
-    def get_html(self, generated):
+    def get_html(self, generated, image_format='bmp'):
         id2word = self.vocabulary(value_type='language')
         questions = generated['question']
         question_lengths = generated['question_length']
         answers = generated['answer']
         data_html = list()
         for n, (question, question_length, answer) in enumerate(zip(questions, question_lengths, answers)):
-            data_html.append('<div class="instance"><div class="world"><img src="world-{world}.bmp" alt="world-{world}.bmp"></div><div class="num"><p><b>({num})</b></p></div><div class="questions">'.format(world=n, num=(n + 1)))
+            data_html.append('<div class="instance"><div class="world"><img src="world-{world}.{image_format}" alt="world-{world}.{image_format}"></div><div class="num"><p><b>({num})</b></p></div><div class="questions">'.format(image_format=image_format, world=n, num=(n + 1)))
             for question, question_length, answer in zip(question, question_length, answer):
                 data_html.append('<p>{question}&ensp;&ndash;&ensp;{answer}</p>'.format(
                     question=util.tokens2string(id2word[word] for word in question[:question_length]),
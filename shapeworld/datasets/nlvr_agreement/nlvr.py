@@ -50,7 +50,7 @@ class NLVR(Dataset):
             batch['agreement'][i] = agreement
         return batch
 
-    def get_html(self, generated):
+    def get_html(self, generated, image_format='bmp'):
         id2word = self.vocabulary(value_type='language')
         descriptions = generated['description']
         description_lengths = generated['description_length']
@@ -63,7 +63,8 @@ class NLVR(Dataset):
                 agreement = 'incorrect'
             else:
                 assert False
-            data_html.append('<div class="{agreement}"><div class="world"><img src="world1-{world}.bmp" alt="world1-{world}.bmp"></div><div class="vertical"></div><div class="world"><img src="world2-{world}.bmp" alt="world2-{world}.bmp"></div><div class="vertical"></div><div class="world"><img src="world3-{world}.bmp" alt="world3-{world}.bmp"></div><div class="num"><p><b>({num})</b></p></div><div class="description"><p>{description}</p></div></div>'.format(
+            data_html.append('<div class="{agreement}"><div class="world"><img src="world1-{world}.{image_format}" alt="world1-{world}.{image_format}"></div><div class="vertical"></div><div class="world"><img src="world2-{world}.{image_format}" alt="world2-{world}.{image_format}"></div><div class="vertical"></div><div class="world"><img src="world3-{world}.{image_format}" alt="world3-{world}.{image_format}"></div><div class="num"><p><b>({num})</b></p></div><div class="description"><p>{description}</p></div></div>'.format(
+                image_format=image_format,
                 agreement=agreement,
                 world=n,
                 num=(n + 1),
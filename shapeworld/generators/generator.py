@@ -65,22 +65,22 @@ class GeneratorMixer(WorldGenerator):
         super(GeneratorMixer, self).__init__(world_size=generators[0].world_size, world_color=generators[0].world_color, shapes=generators[0].shapes, colors=generators[0].colors, textures=generators[0].textures, rotation=generators[0].rotation, size_range=generators[0].size_range, distortion_range=generators[0].distortion_range, shade_range=generators[0].shade_range, collision_tolerance=generators[0].collision_tolerance, boundary_tolerance=generators[0].boundary_tolerance)
         self.generators = generators
         distribution = util.value_or_default(distribution, [1] * len(generators))
-        self.distribution = util.cumulative_distribution(distribution)
-        self.train_distribution = util.cumulative_distribution(util.value_or_default(train_distribution, distribution))
-        self.validation_distribution = util.cumulative_distribution(util.value_or_default(validation_distribution, distribution))
-        self.test_distribution = util.cumulative_distribution(util.value_or_default(test_distribution, distribution))
+        self.distribution = util.AliasSampler(distribution)
+        self.train_distribution = util.AliasSampler(util.value_or_default(train_distribution, distribution))
+        self.validation_distribution = util.AliasSampler(util.value_or_default(validation_distribution, distribution))
+        self.test_distribution = util.AliasSampler(util.value_or_default(test_distribution, distribution))
 
     def initialize(self, mode):
         super(GeneratorMixer, self).initialize(mode=mode)
 
         if mode is None:
-            self.generator = util.sample(self.distribution, self.generators)
+            self.generator = self.distribution.sample(self.generators)
         elif mode == 'train':
-            self.generator = util.sample(self.train_distribution, self.generators)
+            self.generator = self.train_distribution.sample(self.generators)
         elif mode == 'validation':
-            self.generator = util.sample(self.validation_distribution, self.generators)
+            self.generator = self.validation_distribution.sample(self.generators)
         elif mode == 'test':
-            self.generator = util.sample(self.test_distribution, self.generators)
+            self.generator = self.test_distribution.sample(self.generators)
 
         self.generator.initialize(mode=mode)
 
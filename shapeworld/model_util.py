@@ -0,0 +1,320 @@
+from io import BytesIO
+import numpy as np
+
+
+# per world its size and color, per entity its attributes with ids into the shape, color and texture tables
+world_dtype = np.dtype([('size', np.int32), ('color', np.int32), ('shade', np.float64)])
+entity_dtype = np.dtype([('id', np.int32), ('shape', np.int32), ('size', np.float64, (2,)), ('color', np.int32), ('shade', np.float64), ('texture', np.int32), ('center', np.float64, (2,)), ('rotation', np.float64)])
+
+
+class WorldModels(object):
+    # world models as structured arrays, dicts are only built on access
+
+    def __init__(self, worlds, offsets, entities, shapes, colors, rgbs, textures):
+        assert len(offsets) == len(worlds) + 1 and offsets[-1] == len(entities)
+        self.worlds = worlds
+        self.offsets = offsets
+        self.entities = entities
+        self.shapes = list(shapes)
+        self.colors = list(colors)
+        self.rgbs = rgbs
+        self.textures = list(textures)
+
+    def __len__(self):
+        return len(self.worlds)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        world = self.worlds[index]
+        return {
+            'size': int(world['size']),
+            'color': self.color_model(color=world['color'], shade=world['shade']),
+            'entities': [{
+                'id': int(entity['id']),
+                'shape': {'name': self.shapes[entity['shape']], 'size': {'x': float(entity['size'][0]), 'y': float(entity['size'][1])}},
+                'color': self.color_model(color=entity['color'], shade=entity['shade']),
+                'texture': {'name': self.textures[entity['texture']]},
+                'center': {'x': float(entity['center'][0]), 'y': float(entity['center'][1])},
+                'rotation': float(entity['rotation'])
+            } for entity in self.world_entities(index=index)]
+        }
+
+    def color_model(self, color, shade):
+        return {'name': self.colors[color], 'rgb': self.rgbs[color].tolist(), 'shade': float(shade)}
+
+    def world_entities(self, index):
+        return self.entities[self.offsets[index]: self.offsets[index + 1]]
+
+    def arrays(self):
+        return dict(worlds=self.worlds, offsets=self.offsets, entities=self.entities, shapes=np.array(self.shapes, dtype=str), colors=np.array(self.colors, dtype=str), rgbs=self.rgbs, textures=np.array(self.textures, dtype=str))
+
+    @staticmethod
+    def encode(models):
+        # None if the models do not follow the world model schema
+        shapes = dict()
+        colors = dict()
+        textures = dict()
+        worlds = np.zeros(shape=(len(models),), dtype=world_dtype)
+        offsets = np.zeros(shape=(len(models) + 1,), dtype=np.int64)
+        entities = list()
+        try:
+            for n, model in enumerate(models):
+                worlds[n] = (model['size'], colors.setdefault((model['color']['name'], tuple(model['color']['rgb'])), len(colors)), model['color']['shade'])
+                for entity in model['entities']:
+                    entities.append((
+                        entity['id'],
+                        shapes.setdefault(entity['shape']['name'], len(shapes)),
+                        (entity['shape']['size']['x'], entity['shape']['size']['y']),
+                        colors.setdefault((entity['color']['name'], tuple(entity['color']['rgb'])), len(colors)),
+                        entity['color']['shade'],
+                        textures.setdefault(entity['texture']['name'], len(textures)),
+                        (entity['center']['x'], entity['center']['y']),
+                        entity['rotation']
+                    ))
+                offsets[n + 1] = len(entities)
+        except (KeyError, TypeError, ValueError):
+            return None
+        colors = sorted(colors, key=colors.get)
+        encoded = WorldModels(
+            worlds=worlds,
+            offsets=offsets,
+            entities=np.array(entities, dtype=entity_dtype),
+            shapes=sorted(shapes, key=shapes.get),
+            colors=[name for name, _ in colors],
+            rgbs=np.array([rgb for _, rgb in colors], dtype=np.float64).reshape(len(colors), 3),
+            textures=sorted(textures, key=textures.get)
+        )
+        # additional or differently typed model values are not representable
+        if any(encoded[n] != model for n, model in enumerate(models)):
+            return None
+        return encoded
+
+    @staticmethod
+    def concatenate(columns):
+        # ids of the first column's tables extended by the others
+        shapes = list()
+        colors = list()
+        textures = list()
+        worlds = list()
+        offsets = [np.zeros(shape=(1,), dtype=np.int64)]
+        entities = list()
+        num_entities = 0
+        for column in columns:
+            shape_ids = np.array([WorldModels.table_id(shapes, shape) for shape in column.shapes] or [0], dtype=np.int32)
+            color_ids = np.array([WorldModels.table_id(colors, (color, tuple(rgb))) for color, rgb in zip(column.colors, column.rgbs.tolist())] or [0], dtype=np.int32)
+            texture_ids = np.array([WorldModels.table_id(textures, texture) for texture in column.textures] or [0], dtype=np.int32)
+            column_worlds = column.worlds.copy()
+            column_worlds['color'] = color_ids[column_worlds['color']]
+            worlds.append(column_worlds)
+            column_entities = column.entities.copy()
+            column_entities['shape'] = shape_ids[column_entities['shape']]
+            column_entities['color'] = color_ids[column_entities['color']]
+            column_entities['texture'] = texture_ids[column_entities['texture']]
+            offsets.append(column.offsets[1:] + num_entities)
+            entities.append(column_entities)
+            num_entities += len(column_entities)
+        return WorldModels(
+            worlds=np.concatenate(worlds) if worlds else np.zeros(shape=(0,), dtype=world_dtype),
+            offsets=np.concatenate(offsets),
+            entities=np.concatenate(entities) if entities else np.zeros(shape=(0,), dtype=entity_dtype),
+            shapes=shapes,
+            colors=[name for name, _ in colors],
+            rgbs=np.array([rgb for _, rgb in colors], dtype=np.float64).reshape(len(colors), 3),
+            textures=textures
+        )
+
+    @staticmethod
+    def table_id(table, value):
+        if value not in table:
+            table.append(value)
+        return table.index(value)
+
+    @staticmethod
+    def from_arrays(arrays):
+        return WorldModels(worlds=arrays['worlds'], offsets=arrays['offsets'], entities=arrays['entities'], shapes=arrays['shapes'].tolist(), colors=arrays['colors'].tolist(), rgbs=arrays['rgbs'], textures=arrays['textures'].tolist())
+
+
+class TreeModels(object):
+    # json trees in prefix order, per node its kind and a value which is the number of children for dicts and lists,
+    # the id into the string or number table, or the integer itself, dict children are preceded by their key string
+
+    DICT, LIST, STRING, INT, FLOAT, BOOL, NONE = range(7)
+
+    def __init__(self, kinds, values, offsets, strings, numbers):
+        assert len(kinds) == len(values) and offsets[-1] == len(kinds)
+        self.kinds = kinds
+        self.values = values
+        self.offsets = offsets
+        self.strings = list(strings)
+        self.numbers = numbers
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        start = self.offsets[index]
+        end = self.offsets[index + 1]
+        kinds = self.kinds[start:end].tolist()
+        values = self.values[start:end].tolist()
+        model, position = self.build(kinds=kinds, values=values, position=0)
+        assert position == len(kinds)
+        return model
+
+    def build(self, kinds, values, position):
+        kind = kinds[position]
+        value = values[position]
+        position += 1
+        if kind == TreeModels.DICT:
+            model = dict()
+            for _ in range(value):
+                assert kinds[position] == TreeModels.STRING
+                key = self.strings[values[position]]
+                model[key], position = self.build(kinds=kinds, values=values, position=(position + 1))
+            return model, position
+        elif kind == TreeModels.LIST:
+            model = list()
+            for _ in range(value):
+                child, position = self.build(kinds=kinds, values=values, position=position)
+                model.append(child)
+            return model, position
+        elif kind == TreeModels.STRING:
+            return self.strings[value], position
+        elif kind == TreeModels.INT:
+            return value, position
+        elif kind == TreeModels.FLOAT:
+            return float(self.numbers[value]), position
+        elif kind == TreeModels.BOOL:
+            return bool(value), position
+        else:
+            return None, position
+
+    def arrays(self):
+        return dict(kinds=self.kinds, values=self.values, offsets=self.offsets, strings=np.array(self.strings, dtype=str), numbers=self.numbers)
+
+    @staticmethod
+    def encode(models):
+        kinds = list()
+        values = list()
+        offsets = [0]
+        strings = dict()
+        numbers = list()
+        for model in models:
+            stack = [model]
+            while stack:
+                value = stack.pop()
+                if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+                    value = value.tolist()
+                if isinstance(value, dict):
+                    kinds.append(TreeModels.DICT)
+                    values.append(len(value))
+                    for key, child in reversed(list(value.items())):
+                        assert isinstance(key, str)
+                        stack.append(child)
+                        stack.append(key)
+                elif isinstance(value, list) or isinstance(value, tuple):
+                    kinds.append(TreeModels.LIST)
+                    values.append(len(value))
+                    stack.extend(reversed(value))
+                elif isinstance(value, str):
+                    kinds.append(TreeModels.STRING)
+                    values.append(strings.setdefault(value, len(strings)))
+                elif isinstance(value, bool):
+                    kinds.append(TreeModels.BOOL)
+                    values.append(int(value))
+                elif isinstance(value, int):
+                    kinds.append(TreeModels.INT)
+                    values.append(value)
+                elif isinstance(value, float):
+                    kinds.append(TreeModels.FLOAT)
+                    values.append(len(numbers))
+                    numbers.append(value)
+                else:
+                    assert value is None
+                    kinds.append(TreeModels.NONE)
+                    values.append(0)
+            offsets.append(len(kinds))
+        return TreeModels(
+            kinds=np.array(kinds, dtype=np.uint8),
+            values=np.array(values, dtype=np.int64),
+            offsets=np.array(offsets, dtype=np.int64),
+            strings=sorted(strings, key=strings.get),
+            numbers=np.array(numbers, dtype=np.float64)
+        )
+
+    @staticmethod
+    def concatenate(columns):
+        # string ids of the first column's table extended by the others
+        strings = list()
+        kinds = list()
+        values = list()
+        offsets = [np.zeros(shape=(1,), dtype=np.int64)]
+        numbers = list()
+        num_nodes = num_numbers = 0
+        for column in columns:
+            string_ids = np.array([WorldModels.table_id(strings, string) for string in column.strings] or [0], dtype=np.int64)
+            column_values = column.values.copy()
+            is_string = (column.kinds == TreeModels.STRING)
+            column_values[is_string] = string_ids[column_values[is_string]]
+            is_float = (column.kinds == TreeModels.FLOAT)
+            column_values[is_float] += num_numbers
+            offsets.append(column.offsets[1:] + num_nodes)
+            kinds.append(column.kinds)
+            values.append(column_values)
+            numbers.append(column.numbers)
+            num_nodes += len(column.kinds)
+            num_numbers += len(column.numbers)
+        return TreeModels(
+            kinds=np.concatenate(kinds) if kinds else np.zeros(shape=(0,), dtype=np.uint8),
+            values=np.concatenate(values) if values else np.zeros(shape=(0,), dtype=np.int64),
+            offsets=np.concatenate(offsets),
+            strings=strings,
+            numbers=np.concatenate(numbers) if numbers else np.zeros(shape=(0,), dtype=np.float64)
+        )
+
+    @staticmethod
+    def from_arrays(arrays):
+        return TreeModels(kinds=arrays['kinds'], values=arrays['values'], offsets=arrays['offsets'], strings=arrays['strings'].tolist(), numbers=arrays['numbers'])
+
+
+def encode_models(models):
+    # world models as structured arrays, other models as trees
+    encoded = WorldModels.encode(models=models)
+    if encoded is None:
+        encoded = TreeModels.encode(models=models)
+    return encoded
+
+
+def concatenate_models(columns):
+    if all(isinstance(column, WorldModels) for column in columns):
+        return WorldModels.concatenate(columns=columns)
+    elif all(isinstance(column, TreeModels) for column in columns):
+        return TreeModels.concatenate(columns=columns)
+    else:
+        return TreeModels.encode(models=[model for column in columns for model in column])
+
+
+def write_models(models):
+    models_bytes = BytesIO()
+    np.savez_compressed(models_bytes, **models.arrays())
+    return models_bytes.getvalue()
+
+
+def read_models(models_bytes):
+    with np.load(BytesIO(models_bytes), allow_pickle=False) as arrays:
+        if 'entities' in arrays:
+            return WorldModels.from_arrays(arrays=arrays)
+        else:
+            return TreeModels.from_arrays(arrays=arrays)
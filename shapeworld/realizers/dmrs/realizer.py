@@ -198,6 +198,7 @@ class DmrsRealizer(CaptionRealizer):
             self.post_processing[str(key)] = (search, replace)
 
     def realize(self, captions):
+        timer = util.StageTimer(prefix='realize/', enabled=(self.metrics is not None))
         try:
             ace = subprocess.Popen([self.ace_path, '-g', self.erg_path, '-1e', '-r', 'root_strict'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         except Exception as e:
@@ -207,47 +208,48 @@ class DmrsRealizer(CaptionRealizer):
             print(e.strerror)
             print(sys.exc_info()[0])
             raise
-        dmrs_list = list()
+        timer.stage('ace')
         mrs_list = list()
         for caption in captions:
             dmrs = self.caption_dmrs(caption=caption)
             dmrs = dmrs.apply_paraphrases(self.post_processing.values())
             dmrs.remove_underspecifications()
-            dmrs_list.append(dmrs)
             mrs_list.append(dmrs.get_mrs() + '\n')
+        timer.stage('dmrs')
         stdout_data, stderr_data = ace.communicate(input=''.join(mrs_list).encode())
+        timer.stage('ace')
         stderr_data = stderr_data.decode('utf-8').splitlines()
         stdout_data = stdout_data.decode('utf-8').splitlines()
 
-        failures = 0
+        # failures and unexpected ace output only counted, as failed captions are resampled
+        failed = set()
+        unexpected = 0
         n = 0
-        unexpected = False
         for line in stderr_data:
             if n == len(captions):
                 assert self.final_regex.match(line), line
                 continue
             if self.successful_regex.match(line):
-                if unexpected:
-                    print(dmrs_list[n].dumps_xml().decode())
-                    print(mrs_list[n])
-                    unexpected = False
                 n += 1
             elif self.unsuccessful_regex.match(line):
-                print(dmrs_list[n].dumps_xml().decode())
-                print(mrs_list[n])
-                failures += 1
+                failed.add(n)
                 n += 1
             else:
-                print('Unexpected: ' + line)
-                unexpected = True
-        if failures > 0:
-            print('Failures: {}'.format(failures))
-            exit(0)
-
-        caption_strings = [line for line in stdout_data if line]
-        assert len(caption_strings) == len(captions), stdout_data + '\n' + stderr_data
-        for n, caption in enumerate(caption_strings):
-            captions[n] = util.string2tokens(string=caption)
+                unexpected += 1
+
+        # failed captions are None, to be resampled by the dataset
+        caption_strings = iter(line for line in stdout_data if line)
+        for n in range(len(captions)):
+            if n in failed:
+                captions[n] = None
+            else:
+                caption = next(caption_strings, None)
+                assert caption is not None, '\n'.join(stdout_data + stderr_data)
+                captions[n] = util.string2tokens(string=caption)
+        assert next(caption_strings, None) is None, '\n'.join(stdout_data + stderr_data)
+        timer.stage('parsing')
+        if self.metrics is not None:
+            self.metrics.record(counters=dict(realizer_failures=len(failed), realizer_unexpected_lines=unexpected), timings=timer.timings)
         return captions
 
     def attribute_dmrs(self, attribute):
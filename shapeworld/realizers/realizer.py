@@ -8,6 +8,8 @@ class CaptionRealizer(object):
         self.attributes = None
         self.relations = None
         self.quantifiers = None
+        # util.Metrics recording realization timings and failures, if any
+        self.metrics = None
 
     @staticmethod
     def from_name(name, language):
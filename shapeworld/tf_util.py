@@ -111,9 +111,13 @@ def write_record(dataset, record):
 
 
 def write_records(dataset, records, path):
-    num_records = len(next(iter(records.values())))
+    # records as one batch or as an iterable of batches
+    if isinstance(records, dict):
+        records = (records,)
     with tf.python_io.TFRecordWriter(path=(path + '.tfrecords.gz'), options=options) as writer:
-        for n in range(num_records):
-            record = {value_name: value[n] for value_name, value in records.items()}
-            serialized_record = write_record(dataset=dataset, record=record)
-            writer.write(record=serialized_record)
+        for batch in records:
+            num_records = len(next(iter(batch.values())))
+            for n in range(num_records):
+                record = {value_name: value[n] for value_name, value in batch.items()}
+                serialized_record = write_record(dataset=dataset, record=record)
+                writer.write(record=serialized_record)
@@ -1,14 +1,23 @@
 from __future__ import division
 from collections import Counter, namedtuple
 from itertools import chain, combinations
+import hashlib
 import json
 from math import ceil, cos, floor, pi, sin, sqrt, trunc
+from io import BytesIO
 from operator import __truediv__
 import os
+import random as random_module
+import shutil
+import sqlite3
+import sys
 from random import randint, random, randrange, uniform
 import tarfile
+import tempfile
 import time
 import zipfile
+import zlib
+import numpy as np
 
 
 def value_or_default(value, default):
@@ -88,6 +97,31 @@ def tokens2string(tokens):
     return ' '.join(tokens).replace(' , ', ', ').replace(' ; ', '; ').replace(' .', '.').replace(' ?', '?')
 
 
+def write_atomic(path, value):
+    # readers never see a partially written file
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as filehandle:
+        filehandle.write(value)
+    os.replace(temp_path, path)
+
+
+def checksum(path):
+    # sha256 and size in bytes of a file, or of all files in a directory
+    sha256 = hashlib.sha256()
+    size = 0
+    if os.path.isdir(path):
+        paths = [os.path.join(path, filename) for filename in sorted(os.listdir(path))]
+    else:
+        paths = [path]
+    for filepath in paths:
+        sha256.update(os.path.basename(filepath).encode())
+        with open(filepath, 'rb') as filehandle:
+            for chunk in iter(lambda: filehandle.read(1 << 20), b''):
+                sha256.update(chunk)
+                size += len(chunk)
+    return sha256.hexdigest(), size
+
+
 def product(xs):
     prod = 1
     for x in xs:
@@ -189,6 +223,69 @@ def sample(cumulative_distribution, items=None):
                 return index
 
 
+class AliasSampler(object):
+
+    # alias method: O(1) per sample, built once per distribution
+    def __init__(self, distribution):
+        if isinstance(distribution, int):
+            assert distribution > 0
+            distribution = [1] * distribution
+        weights = np.maximum(np.asarray(distribution, dtype=np.float64), 0.0)  # negative values are zero
+        assert weights.ndim == 1 and weights.sum() > 0.0
+        self.size = len(weights)
+        scaled = weights * self.size / weights.sum()
+        self.probabilities = np.ones(shape=(self.size,), dtype=np.float64)
+        self.aliases = np.arange(self.size)
+        small = [index for index in range(self.size) if scaled[index] < 1.0]
+        large = [index for index in range(self.size) if scaled[index] >= 1.0]
+        while small and large:
+            index = small.pop()
+            alias = large.pop()
+            self.probabilities[index] = scaled[index]
+            self.aliases[index] = alias
+            scaled[alias] += scaled[index] - 1.0
+            if scaled[alias] < 1.0:
+                small.append(alias)
+            else:
+                large.append(alias)
+        self.probabilities_list = self.probabilities.tolist()
+        self.aliases_list = self.aliases.tolist()
+
+    def sample(self, items=None):
+        sample = random() * self.size
+        index = int(sample)
+        if sample - index >= self.probabilities_list[index]:
+            index = self.aliases_list[index]
+        if items:
+            return items[index]
+        else:
+            return index
+
+    def sample_batch(self, n=None, uniforms=None, rng=None):
+        if uniforms is None:
+            uniforms = value_or_default(rng, np.random).random(size=n)
+        samples = np.asarray(uniforms) * self.size
+        indices = np.minimum(samples.astype(np.int64), self.size - 1)
+        return np.where(samples - indices < self.probabilities[indices], indices, self.aliases[indices])
+
+
+def seed_sequence(seed, *keys):
+    # keys like mode and part number identify independent streams derived from the same root seed
+    spawn_key = tuple(zlib.crc32(str(key).encode()) for key in keys)
+    return np.random.SeedSequence(entropy=seed, spawn_key=spawn_key)
+
+
+def set_random_seed(seed, *keys):
+    state = seed_sequence(seed, *keys).generate_state(n_words=2)
+    random_module.seed(int(state[0]))
+    np.random.seed(int(state[1]))
+
+
+def shard_range(size, num_shards, shard):
+    assert 0 <= shard < num_shards
+    return size * shard // num_shards, size * (shard + 1) // num_shards
+
+
 # def sample_softmax(logits, temperature=1.0):
 #     probabilities = [exp(logit / temperature) for logit in logits]
 #     probabilities /= sum(probabilities)
@@ -501,10 +598,7 @@ class Archive(object):
         assert archive in (None, 'zip', 'zip:none', 'zip:deflate', 'zip:bzip2', 'zip:lzma', 'tar', 'tar:none', 'tar:gzip', 'tar:bzip2', 'tar:lzma')
         self.archive = path
         self.mode = mode
-        if not os.path.isdir('/tmp/shapeworld'):
-            os.makedirs('/tmp/shapeworld')
-        self.temp_directory = os.path.join('/tmp/shapeworld', str(time.time()))
-        os.mkdir(self.temp_directory)
+        self.streams = dict()
         if archive is None:
             self.archive_type = None
             if not os.path.isdir(self.archive):
@@ -521,33 +615,57 @@ class Archive(object):
                 compression = zipfile.ZIP_BZIP2
             elif archive[4:] == 'lzma':
                 compression = zipfile.ZIP_LZMA
-            if not self.archive.endswith('.zip'):
-                self.archive += '.zip'
-            self.archive = zipfile.ZipFile(self.archive, mode, compression)
+            self.archive = zipfile.ZipFile(Archive.get_path(path=path, archive=archive), mode, compression)
         elif archive[:3] == 'tar':
             self.archive_type = 'tar'
-            if len(archive) == 3:
-                mode += ':gz'
-                extension = '.gz'
-            elif archive[4:] == 'none':
-                extension = ''
-            elif archive[4:] == 'gzip':
+            if len(archive) == 3 or archive[4:] == 'gzip':
                 mode += ':gz'
-                extension = '.gz'
             elif archive[4:] == 'bzip2':
                 mode += ':bz2'
-                extension = '.bz2'
             elif archive[4:] == 'lzma':
                 mode += ':xz'
-                extension = '.lzma'
-            if not self.archive.endswith('.tar' + extension):
-                self.archive += '.tar' + extension
-            self.archive = tarfile.open(self.archive, mode)
+            self.archive = tarfile.open(Archive.get_path(path=path, archive=archive), mode)
+            if self.mode == 'r':
+                # name index instead of linear member lookups
+                self.members = {member.name: member for member in self.archive.getmembers()}
+
+    @staticmethod
+    def get_path(path, archive=None):
+        # path of the archive file, or directory if no archive
+        if archive is None:
+            return path
+        elif archive[:3] == 'zip':
+            extension = '.zip'
+        elif len(archive) == 3 or archive[4:] == 'gzip':
+            extension = '.tar.gz'
+        elif archive[4:] == 'none':
+            extension = '.tar'
+        elif archive[4:] == 'bzip2':
+            extension = '.tar.bz2'
+        elif archive[4:] == 'lzma':
+            extension = '.tar.lzma'
+        if path.endswith(extension):
+            return path
+        else:
+            return path + extension
 
     def close(self):
+        # streams are added to archives at the end, since archive entries are written one at a time
+        for filename, stream in self.streams.items():
+            if self.archive_type == 'zip':
+                stream.seek(0)
+                with self.archive.open(filename, mode='w', force_zip64=True) as filehandle:
+                    shutil.copyfileobj(stream, filehandle)
+            elif self.archive_type == 'tar':
+                fileinfo = tarfile.TarInfo(name=filename)
+                fileinfo.size = stream.tell()
+                fileinfo.mtime = time.time()
+                stream.seek(0)
+                self.archive.addfile(tarinfo=fileinfo, fileobj=stream)
+            stream.close()
+        self.streams = dict()
         if self.archive_type is not None:
             self.archive.close()
-        os.rmdir(self.temp_directory)
 
     def __enter__(self):
         if self.mode == 'r':
@@ -577,34 +695,146 @@ class Archive(object):
                 value = value.decode()
             return value
         elif self.archive_type == 'tar':
-            try:
-                fileinfo = self.archive.getmember(filename)
-            except KeyError:
+            fileinfo = self.members.get(filename)
+            if fileinfo is None:
                 return None
-            self.archive.extract(member=fileinfo, path=self.temp_directory)
-            filepath = os.path.join(self.temp_directory, filename)
-            with open(filepath, 'rb' if binary else 'r') as filehandle:
-                value = filehandle.read()
-            os.remove(filepath)
+            value = self.archive.extractfile(fileinfo).read()
+            if not binary:
+                value = value.decode()
             return value
 
+    def read_array(self, filename, mmap=True):
+        if self.archive_type is None:
+            filename = os.path.join(self.archive, filename)
+            if not os.path.isfile(filename):
+                return None
+            return np.load(filename, mmap_mode=('r' if mmap else None), allow_pickle=False)
+        else:
+            value = self.read_file(filename, binary=True)
+            if value is None:
+                return None
+            return np.load(BytesIO(value), allow_pickle=False)
+
+    def open_stream(self, filename):
+        # binary file object for appending to an entry, spooled to disk if large for archives
+        assert self.mode == 'w' and filename not in self.streams
+        if self.archive_type is None:
+            stream = open(os.path.join(self.archive, filename), 'wb')
+        else:
+            stream = tempfile.SpooledTemporaryFile(max_size=(1 << 24))
+        self.streams[filename] = stream
+        return stream
+
     def write_file(self, filename, value, binary=False):
         if self.archive_type is None:
             filename = os.path.join(self.archive, filename)
             with open(filename, 'wb' if binary else 'w') as filehandle:
                 filehandle.write(value)
         elif self.archive_type == 'zip':
-            if binary:
-                filepath = os.path.join(self.temp_directory, filename)
-                with open(filepath, 'wb') as filehandle:
-                    filehandle.write(value)
-                self.archive.write(filepath, filename)
-                os.remove(filepath)
-            else:
-                self.archive.writestr(filename, value)
+            self.archive.writestr(filename, value)
         elif self.archive_type == 'tar':
-            filepath = os.path.join(self.temp_directory, filename)
-            with open(filepath, 'wb' if binary else 'w') as filehandle:
-                filehandle.write(value)
-            self.archive.add(filepath, filename)
-            os.remove(filepath)
+            if not binary:
+                value = value.encode()
+            fileinfo = tarfile.TarInfo(name=filename)
+            fileinfo.size = len(value)
+            fileinfo.mtime = time.time()
+            self.archive.addfile(tarinfo=fileinfo, fileobj=BytesIO(value))
+
+
+class MetadataIndex(object):
+    # sqlite index of the metadata of stored instances, per instance its mode, part path and row within the part
+
+    columns = (('entities', 'INTEGER'), ('captioner', 'TEXT'), ('caption_type', 'TEXT'), ('rpn', 'TEXT'), ('agreement', 'REAL'))
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS instances (mode TEXT, part TEXT, instance INTEGER, {})'.format(', '.join('{} {}'.format(*column) for column in MetadataIndex.columns)))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS instances_part ON instances (mode, part)')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def add_part(self, mode, part, metadata):
+        # replaces previous rows of the part
+        with self.connection:
+            self.connection.execute('DELETE FROM instances WHERE mode = ? AND part = ?', (mode, part))
+            self.connection.executemany(
+                'INSERT INTO instances VALUES ({})'.format(', '.join('?' * (len(MetadataIndex.columns) + 3))),
+                ((mode, part, instance) + tuple(values.get(column) for column, _ in MetadataIndex.columns) for instance, values in enumerate(metadata))
+            )
+
+    def query(self, mode, where=None, parameters=()):
+        # (part, instance) pairs of the mode matching an sql condition, e.g. where='entities >= ? AND captioner LIKE ?'
+        condition = 'mode = ?' if where is None else 'mode = ? AND ({})'.format(where)
+        cursor = self.connection.execute('SELECT part, instance FROM instances WHERE {} ORDER BY part, instance'.format(condition), (mode,) + tuple(parameters))
+        return cursor.fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+class Metrics(object):
+    # counters and timings in seconds accumulated over generated batches, emitted as dict to the callback, or otherwise
+    # as json line to the stream, at most every interval seconds, or after every batch to the callback if no interval,
+    # and only accumulated without interval and callback
+
+    def __init__(self, interval=None, callback=None, stream=None):
+        assert interval is None or interval >= 0.0
+        self.interval = interval
+        self.callback = callback
+        self.stream = value_or_default(stream, sys.stderr)
+        self.counters = Counter()
+        self.timings = Counter()
+        self.last_emit = time.time()
+
+    def record(self, counters=None, timings=None):
+        if counters is not None:
+            self.counters.update(counters)
+        if timings is not None:
+            self.timings.update(timings)
+        if self.interval is None:
+            if self.callback is not None:
+                self.emit()
+        elif time.time() - self.last_emit >= self.interval:
+            self.emit()
+
+    def values(self):
+        return dict(counters=dict(self.counters), timings=dict(self.timings))
+
+    @staticmethod
+    def difference(values, previous):
+        # values accumulated since the previous values
+        return {key: {name: value - previous[key].get(name, 0) for name, value in values[key].items()} for key in ('counters', 'timings')}
+
+    def emit(self):
+        self.last_emit = time.time()
+        if self.callback is None:
+            self.stream.write(json.dumps(self.values(), sort_keys=True) + '\n')
+            self.stream.flush()
+        else:
+            self.callback(self.values())
+
+    def reset(self):
+        self.counters.clear()
+        self.timings.clear()
+
+
+class StageTimer(object):
+    # wall time per stage, each stage ending at its call to stage and starting at the previous one, nothing if disabled
+
+    def __init__(self, prefix, enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.timings = Counter()
+        self.last = time.perf_counter() if enabled else None
+
+    def stage(self, name):
+        if self.enabled:
+            now = time.perf_counter()
+            self.timings[self.prefix + name] += now - self.last
+            self.last = now
@@ -1,6 +1,7 @@
 from __future__ import division
 from math import cos, pi, sin
 from random import choice, random
+import numpy as np
 from shapeworld.util import Point
 from shapeworld.world import Shape, Color, Texture
 
@@ -81,17 +82,17 @@ class Entity(object):
         bottomright = (((self.bottomright + 1.5 * shift) / scale) * world_size).min(world_size)
         color = self.color.get_color()
 
-        for (x, y), point in Point.range(topleft, bottomright, world_size):
-            point = point * scale - shift
-            offset = point - self.center
-            distance = self.distance(offset)
-            if distance == 0.0:
-                # assert offset in self
-                world_array[y, x] = self.texture.get_color(color, offset)
-            else:
-                # assert offset not in self
-                distance = max(1.0 - distance * min(*world_size), 0.0)
-                world_array[y, x] = distance * self.texture.get_color(color, offset) + (1.0 - distance) * world_array[y, x]
+        # all pixels of the bounding box at once, same arithmetic as per pixel
+        start = topleft.__floor__()
+        end = bottomright.__ceil__()
+        x, y = np.meshgrid(np.arange(start.x, end.x), np.arange(start.y, end.y))
+        offset_x = (x / (world_size.x - 1)) * scale.x - shift.x - self.center.x
+        offset_y = (y / (world_size.y - 1)) * scale.y - shift.y - self.center.y
+        distance = self.shape.distance_array(offset_x * self.rotation_cos - offset_y * self.rotation_sin, offset_x * self.rotation_sin + offset_y * self.rotation_cos)
+        # inside full color, outside antialiased by distance
+        alpha = np.where(distance == 0.0, 1.0, np.maximum(1.0 - distance * min(*world_size), 0.0))
+        region = world_array[start.y:end.y, start.x:end.x]
+        region[:] = alpha.astype(dtype=region.dtype)[:, :, None] * self.texture.get_color_array(color, offset_x, offset_y) + (1.0 - alpha).astype(dtype=region.dtype)[:, :, None] * region
 
         if bounding_box:  # draw bounding box
             x1 = world_size + 1
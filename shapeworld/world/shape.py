@@ -1,6 +1,7 @@
 from __future__ import division
 from math import cos, pi, sqrt
 from random import choice, uniform
+import numpy as np
 from shapeworld.util import Point
 
 
@@ -10,6 +11,13 @@ cos18 = cos(0.1 * pi)
 cos45 = sqrt(2.0) / 2.0
 
 
+def positive_length(x, y):
+    # vectorized Point(x, y).positive().length
+    x = np.maximum(x, 0.0)
+    y = np.maximum(y, 0.0)
+    return np.sqrt(x * x + y * y)
+
+
 class Shape(object):
 
     __slots__ = ('size',)
@@ -30,7 +38,8 @@ class Shape(object):
 
     @staticmethod
     def from_model(model):
-        return Shape.shapes[model['name']](size=Point.from_model(model['size']))
+        # model size is the stored half size
+        return Shape.shapes[model['name']](size=(Point.from_model(model['size']) * 2.0))
 
     def copy(self):
         raise NotImplementedError
@@ -41,6 +50,10 @@ class Shape(object):
     def distance(self, offset):
         raise NotImplementedError
 
+    def distance_array(self, x, y):
+        # distance for arrays of offset coordinates
+        raise NotImplementedError
+
     @property
     def area(self):
         raise NotImplementedError
@@ -72,6 +85,9 @@ class WorldShape(Shape):
     def distance(self, offset):
         return (abs(offset) - 0.5).positive().length
 
+    def distance_array(self, x, y):
+        return positive_length(np.abs(x) - 0.5, np.abs(y) - 0.5)
+
     @property
     def area(self):
         return 1.0
@@ -98,6 +114,9 @@ class SquareShape(Shape):
     def distance(self, offset):
         return (abs(offset) - self.size).positive().length
 
+    def distance_array(self, x, y):
+        return positive_length(np.abs(x) - self.size.x, np.abs(y) - self.size.y)
+
     @property
     def area(self):
         return 4.0 * self.size.x * self.size.y
@@ -132,6 +151,9 @@ class RectangleShape(Shape):
     def distance(self, offset):
         return (abs(offset) - self.size).positive().length
 
+    def distance_array(self, x, y):
+        return positive_length(np.abs(x) - self.size.x, np.abs(y) - self.size.y)
+
     @property
     def area(self):
         return 4.0 * self.size.x * self.size.y
@@ -177,6 +199,14 @@ class TriangleShape(Shape):
             linear = min(max(offset.y - offset.x + self.size.x, 0.0) / (self.size.x + 2.0 * self.size.y), 1.0)
             return Point(offset.x - (1.0 - linear) * self.size.x, offset.y - linear * 2.0 * self.size.y).positive().length
 
+    def distance_array(self, x, y):
+        below = y < -self.size.y
+        below_distance = positive_length(np.abs(x) - self.size.x, np.abs(y) - self.size.y)
+        x = np.abs(x)
+        y = y + self.size.y
+        linear = np.minimum(np.maximum(y - x + self.size.x, 0.0) / (self.size.x + 2.0 * self.size.y), 1.0)
+        return np.where(below, below_distance, positive_length(x - (1.0 - linear) * self.size.x, y - linear * 2.0 * self.size.y))
+
     @property
     def area(self):
         return 2.0 * self.size.x * self.size.y
@@ -227,6 +257,22 @@ class PentagonShape(Shape):
             linear = min(max(offset.y - offset.x + self.size.x, 0.0) / (self.size.x + y_length), 1.0)
             return Point(offset.x - (1.0 - linear) * self.size.x, offset.y - linear * y_length).positive().length
 
+    def distance_array(self, x, y):
+        x = np.abs(x)
+        y = y + self.size.y - golden_ratio * 2.0 * self.size.y
+        # below the widest point
+        y_length = golden_ratio * 2.0 * self.size.y
+        bottom = np.maximum(-y - y_length, 0.0)
+        lower_x = x - golden_ratio * self.size.x
+        x_length = (1.0 - golden_ratio) * self.size.x
+        linear = np.minimum(np.maximum(-y - lower_x + x_length, 0.0) / (x_length + y_length), 1.0)
+        lower = np.where(x < golden_ratio * self.size.x, bottom, positive_length(lower_x - (1.0 - linear) * x_length, -y - linear * y_length))
+        # above the widest point
+        y_length = (1.0 - golden_ratio) * 2.0 * self.size.y
+        linear = np.minimum(np.maximum(y - x + self.size.x, 0.0) / (self.size.x + y_length), 1.0)
+        upper = positive_length(x - (1.0 - linear) * self.size.x, y - linear * y_length)
+        return np.where(y < 0.0, lower, upper)
+
     @property
     def area(self):
         return (4.0 * golden_ratio * golden_ratio * self.size.x * self.size.y +
@@ -273,6 +319,11 @@ class CrossShape(Shape):
         else:
             return (offset - Point(self.size.x / 3.0, self.size.y)).positive().length
 
+    def distance_array(self, x, y):
+        x = np.abs(x)
+        y = np.abs(y)
+        return np.where(x > y, positive_length(x - self.size.x, y - self.size.y / 3.0), positive_length(x - self.size.x / 3.0, y - self.size.y))
+
     @property
     def area(self):
         return 20.0 * self.size.x * self.size.y / 9.0
@@ -313,6 +364,9 @@ class CircleShape(Shape):
     def distance(self, offset):
         return max(offset.length - self.size.x, 0.0)
 
+    def distance_array(self, x, y):
+        return np.maximum(np.sqrt(x * x + y * y) - self.size.x, 0.0)
+
     @property
     def area(self):
         return pi * self.size.x * self.size.y
@@ -359,6 +413,10 @@ class SemicircleShape(Shape):
         else:
             return max(offset.length - self.size.x, 0.0)
 
+    def distance_array(self, x, y):
+        y = y + self.size.y
+        return np.where(y < 0.0, positive_length(np.abs(x) - self.size.x, np.abs(y) - 0.0), np.maximum(np.sqrt(x * x + y * y) - self.size.x, 0.0))
+
     @property
     def area(self):
         return pi * self.size.x * self.size.y
@@ -400,6 +458,16 @@ class EllipseShape(Shape):
             return 0.0
         return ((direction - direction / direction_length) * self.size).length
 
+    def distance_array(self, x, y):
+        x = x / self.size.x
+        y = y / self.size.y
+        length = np.sqrt(x * x + y * y)
+        # inside points have distance zero, division only where outside
+        length = np.where(length <= 1.0, np.inf, length)
+        x = (x - x / length) * self.size.x
+        y = (y - y / length) * self.size.y
+        return np.where(np.isinf(length), 0.0, np.sqrt(x * x + y * y))
+
     @property
     def area(self):
         return pi * self.size.x * self.size.y
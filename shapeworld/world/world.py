@@ -34,7 +34,7 @@ class World(Entity):
 
     @staticmethod
     def from_model(model):
-        world = World(size=model['size'], color=Color.from_model(model['color']))
+        world = World(size=model['size'], color=model['color']['name'])
         for entity_model in model['entities']:
             world.entities.append(Entity.from_model(entity_model))
         return world
@@ -106,23 +106,29 @@ class World(Entity):
             entity.id = n
             entity.collisions = {sort_indices.index(i): c for i, c in entity.collisions.items()}
 
-    def get_array(self, noise_range=None):
+    def get_array(self, noise_range=None, rng=None):
         color = self.color.get_color()
         if not color.any():
             world_array = np.zeros(shape=(self.size.y, self.size.x, 3), dtype=np.float32)
         else:
-            world_array = np.tile(A=np.array(object=color, dtype=np.float32), reps=(self.size.x, self.size.y, 1))
+            world_array = np.tile(A=np.array(object=color, dtype=np.float32), reps=(self.size.y, self.size.x, 1))
         self.draw(world_array=world_array, world_size=self.size)
+        World.add_noise(world_array=world_array, noise_range=noise_range, rng=rng)
+        return world_array
+
+    @staticmethod
+    def add_noise(world_array, noise_range, rng=None):
+        # truncated normal pixel noise, in place
         if noise_range is not None and noise_range > 0.0:
-            noise = np.random.normal(loc=0.0, scale=noise_range, size=(self.size.y, self.size.x, 3))
+            rng = util.value_or_default(rng, np.random)
+            noise = rng.normal(loc=0.0, scale=noise_range, size=world_array.shape)
             mask = (noise < -2.0 * noise_range) + (noise > 2.0 * noise_range)
             while np.any(a=mask):
                 noise -= mask * noise
-                noise += mask * np.random.normal(loc=0.0, scale=noise_range, size=(self.size.y, self.size.x, 3))
+                noise += mask * rng.normal(loc=0.0, scale=noise_range, size=world_array.shape)
                 mask = (noise < -2.0 * noise_range) + (noise > 2.0 * noise_range)
             world_array += noise
             np.clip(world_array, a_min=0.0, a_max=1.0, out=world_array)
-        return world_array
 
     @staticmethod
     def get_image(world_array):
@@ -136,3 +142,49 @@ class World(Entity):
             world_array = world_array[:, :, :3]
         assert world_array.shape[2] == 3
         return world_array
+
+    @staticmethod
+    def get_rle(world_array):
+        # lossless encoding of the uint8 image as palette plus run-length encoded palette indices
+        pixels = (world_array * 255.0).astype(dtype=np.uint8)
+        height, width, _ = pixels.shape
+        packed = (pixels[:, :, 0].astype(dtype=np.uint32) << 16) | (pixels[:, :, 1].astype(dtype=np.uint32) << 8) | pixels[:, :, 2]
+        palette, indices = np.unique(packed.reshape(-1), return_inverse=True)
+        starts = np.concatenate([[0], np.flatnonzero(indices[1:] != indices[:-1]) + 1])
+        values = indices[starts]
+        lengths = np.diff(np.append(starts, indices.size))
+        value_dtype = np.uint8 if palette.size <= (1 << 8) else (np.uint16 if palette.size <= (1 << 16) else np.uint32)
+        if lengths.max() < (1 << 16):
+            length_dtype = np.uint16
+            # runs split into byte-sized lengths if smaller
+            counts = (lengths + 254) // 255
+            if counts.sum() * (np.dtype(value_dtype).itemsize + 1) < lengths.size * (np.dtype(value_dtype).itemsize + 2):
+                split_lengths = np.full(shape=(counts.sum(),), fill_value=255, dtype=np.int64)
+                split_lengths[np.cumsum(counts) - 1] = lengths - 255 * (counts - 1)
+                values = np.repeat(values, counts)
+                lengths = split_lengths
+                length_dtype = np.uint8
+        else:
+            length_dtype = np.uint32
+        if palette.size * 3 + values.size * (np.dtype(value_dtype).itemsize + np.dtype(length_dtype).itemsize) >= pixels.size:
+            # raw pixels if not smaller, for instance with pixel noise
+            header = np.array([height, width, 0, 0, 0, 0], dtype=np.uint32)
+            return header.tobytes() + pixels.tobytes()
+        palette = np.stack([(palette >> 16) & 255, (palette >> 8) & 255, palette & 255], axis=1).astype(dtype=np.uint8)
+        header = np.array([height, width, palette.shape[0], values.size, np.dtype(value_dtype).itemsize, np.dtype(length_dtype).itemsize], dtype=np.uint32)
+        return header.tobytes() + palette.tobytes() + values.astype(dtype=value_dtype).tobytes() + lengths.astype(dtype=length_dtype).tobytes()
+
+    @staticmethod
+    def from_rle(rle_bytes):
+        height, width, num_colors, num_runs, value_size, length_size = (int(x) for x in np.frombuffer(rle_bytes, dtype=np.uint32, count=6))
+        offset = 24
+        if num_colors == 0:
+            pixels = np.frombuffer(rle_bytes, dtype=np.uint8, count=(height * width * 3), offset=offset).reshape(height, width, 3)
+            return pixels.astype(dtype=np.float32) / 255.0
+        palette = np.frombuffer(rle_bytes, dtype=np.uint8, count=(num_colors * 3), offset=offset).reshape(num_colors, 3)
+        offset += num_colors * 3
+        values = np.frombuffer(rle_bytes, dtype=np.dtype('u{}'.format(value_size)), count=num_runs, offset=offset)
+        offset += num_runs * value_size
+        lengths = np.frombuffer(rle_bytes, dtype=np.dtype('u{}'.format(length_size)), count=num_runs, offset=offset)
+        pixels = palette[np.repeat(values, lengths)].reshape(height, width, 3)
+        return pixels.astype(dtype=np.float32) / 255.0